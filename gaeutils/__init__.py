@@ -1,10 +1,17 @@
+import collections
 import os
+import random
 import time
 from google.appengine.api import taskqueue, app_identity
 from google.appengine.ext import ndb
 
+from gaeutils import models
+
 __all__ = ['App', 
     'safe_enqueue', 
+    'safe_enqueue_async',
+    'safe_enqueue_batch',
+    'safe_enqueue_batch_async',
     'QueryExec', 
     'urlsafe',
     'fanout',
@@ -39,23 +46,101 @@ class _App(object):
 
 App = _App()
 
-def safe_enqueue(url, max_retry_timeout=2000, **kwargs):
+_TIME_BUDGET = 8 * 60 # seconds; push task deadline is 10 minutes
+
+_BACKOFF_START_MS = 100
+
+def _backoff_delay(timeout_ms):
     """
-    Utility to enqueue a task.
+    Jittered delay in seconds; somewhere in the upper half of timeout_ms 
+    so concurrent retries do not all land at the same moment.
+    """
+    return (timeout_ms / 2.0 + random.uniform(0, timeout_ms / 2.0)) / 1000.0
+
+@ndb.tasklet
+def _add_async(queue, tasks, transactional=False, max_retry_timeout=2000):
+    """
+    Adds a list of tasks in one rpc. Transient errors are retried, 
+    for the tasks that were not enqueued, with jittered exponential 
+    backoff until max_retry_timeout (ms) has been spent.
+    Backoff is an ndb.sleep so other tasklets keep running.
     """
-    timeout_ms = 100
-    while timeout_ms < max_retry_timeout or max_retry_timeout == 0:
+    deadline = time.time() + max_retry_timeout / 1000.0
+    timeout_ms = _BACKOFF_START_MS
+    while tasks:
         try:
-            taskqueue.add(url=url, **kwargs)
+            yield queue.add_async(tasks, transactional=transactional)
             break
         except taskqueue.TransientError: # try again
+            delay = _backoff_delay(timeout_ms)
             # max timeout of 0 is signal to not retry
-            if max_retry_timeout == 0:
+            if max_retry_timeout == 0 or time.time() + delay > deadline:
                 break
-            time.sleep(timeout_ms/1000)
+            yield ndb.sleep(delay)
             timeout_ms *= 2
+            tasks = [task for task in tasks if not task.was_enqueued]
         except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError): 
-            break # already queued
+            # already queued, but the error names no task; the others 
+            # that did not go in may have failed for another reason
+            tasks = [task for task in tasks if not task.was_enqueued]
+            if len(tasks) <= 1:
+                break # that was the duplicate
+            # one at a time, each finds out for itself
+            remaining_ms = max(0, int((deadline - time.time()) * 1000))
+            yield [_add_async(queue, [task], 
+                    transactional=transactional, 
+                    max_retry_timeout=remaining_ms if max_retry_timeout else 0) 
+                for task in tasks]
+            break
+
+@ndb.tasklet
+def safe_enqueue_async(url, max_retry_timeout=2000, **kwargs):
+    """
+    Tasklet to enqueue a task. kwargs are the same as taskqueue.add.
+    Result is the Task; check was_enqueued to tell if it 
+    was added or already existed.
+    """
+    queue = taskqueue.Queue(kwargs.pop('queue_name', taskqueue.DEFAULT_QUEUE))
+    transactional = kwargs.pop('transactional', False)
+    task = taskqueue.Task(url=url, **kwargs)
+    yield _add_async(queue, [task], 
+            transactional=transactional, 
+            max_retry_timeout=max_retry_timeout)
+    raise ndb.Return(task)
+
+def safe_enqueue(url, max_retry_timeout=2000, **kwargs):
+    """
+    Utility to enqueue a task.
+    """
+    return safe_enqueue_async(url, max_retry_timeout=max_retry_timeout, **kwargs).get_result()
+
+@ndb.tasklet
+def safe_enqueue_batch_async(tasks, queue_name=taskqueue.DEFAULT_QUEUE, 
+        transactional=False, max_retry_timeout=2000):
+    """
+    Tasklet to enqueue many tasks at once.
+    Tasks are sent in batches of up to MAX_TASKS_PER_ADD, all 
+    batches in flight at the same time. Tasks that already exist 
+    or are tombstoned are skipped; transient failures are retried 
+    for the tasks in a batch that were not enqueued.
+    """
+    queue = taskqueue.Queue(queue_name)
+    pending = [task for task in tasks if not task.was_enqueued]
+    yield [_add_async(queue, pending[i:i + taskqueue.MAX_TASKS_PER_ADD], 
+                transactional=transactional, 
+                max_retry_timeout=max_retry_timeout)
+            for i in xrange(0, len(pending), taskqueue.MAX_TASKS_PER_ADD)]
+    raise ndb.Return(tasks)
+
+def safe_enqueue_batch(tasks, queue_name=taskqueue.DEFAULT_QUEUE, 
+        transactional=False, max_retry_timeout=2000):
+    """
+    Utility to enqueue many tasks at once.
+    """
+    return safe_enqueue_batch_async(tasks, 
+            queue_name=queue_name, 
+            transactional=transactional, 
+            max_retry_timeout=max_retry_timeout).get_result()
 
 def urlsafe(key_repr):
     """
@@ -114,17 +199,81 @@ class PageFuture(object):
         items, next_curs, more = self.future.get_result()
         return items
 
+def _encoded_size(item):
+    """ Size of a query result, entity or key, as protocol buffer. """
+    if isinstance(item, ndb.Key):
+        return item.reference().ByteSize()
+    return item._to_pb().ByteSize()
+
 class QueryExec(object):
-    def __init__(self, query, batch_size=300):
+    def __init__(self, query, batch_size=300, prefetch=0):
+        """
+        prefetch is how many pages beyond the current one 
+        are kept requested while the current one is worked on.
+        """
         self.query = query
         self.batch_size = batch_size
+        self.prefetch = prefetch
 
-    def get_by_page_async(self, **kwargs):
-        more, next_curs = True, None
-        while more:
-            future = self.query.fetch_page_async(self.batch_size, start_cursor=next_curs, **kwargs)
+    @ndb.tasklet
+    def _fetch_after_async(self, prev, **kwargs):
+        """
+        Fetches the page after prev as soon as its cursor is known.
+        Pages come from cursors, so this is how pages get requested 
+        ahead of the caller without waiting on the caller.
+        """
+        page, next_curs, more = yield prev
+        if not more:
+            raise ndb.Return(([], None, False))
+        result = yield self.query.fetch_page_async(self.batch_size, start_cursor=next_curs, **kwargs)
+        raise ndb.Return(result)
+
+    def _fill_ahead(self, future, ahead, prefetch, **kwargs):
+        # chain on the last page requested
+        last = ahead[-1] if ahead else future
+        while len(ahead) < prefetch:
+            last = self._fetch_after_async(last, **kwargs)
+            ahead.append(last)
+
+    def get_by_page_async(self, prefetch=None, **kwargs):
+        """
+        Generator yielding a future per page.
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        ahead = collections.deque()
+        future = self.query.fetch_page_async(self.batch_size, start_cursor=None, **kwargs)
+        while True:
+            self._fill_ahead(future, ahead, prefetch, **kwargs)
             yield PageFuture(future)
             page, next_curs, more = future.get_result()
+            if not more:
+                break
+            if ahead:
+                future = ahead.popleft()
+            else:
+                future = self.query.fetch_page_async(self.batch_size, start_cursor=next_curs, **kwargs)
+
+    @ndb.tasklet
+    def map_async(self, callback, prefetch=None, **kwargs):
+        """
+        Calls callback with each page while the next page is fetched.
+        callback may be a tasklet, in which case the callbacks run 
+        alongside the fetches. Result is the list of callback 
+        results in page order.
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        results = []
+        ahead = collections.deque()
+        future = self.query.fetch_page_async(self.batch_size, start_cursor=None, **kwargs)
+        while future is not None:
+            # at least the next page is always in flight during callback
+            self._fill_ahead(future, ahead, max(prefetch, 1), **kwargs)
+            page, next_curs, more = yield future
+            future = ahead.popleft() if more else None
+            results.append(callback(page))
+        yield [result for result in results if isinstance(result, ndb.Future)]
+        raise ndb.Return([result.get_result() if isinstance(result, ndb.Future) else result 
+                for result in results])
 
     def get_by_page(self, **kwargs):
         """
@@ -134,6 +283,29 @@ class QueryExec(object):
             items = page_fut.get_result()
             yield items
 
+    def iter_entities(self, max_items=None, max_bytes=None, **kwargs):
+        """
+        Generator yielding one entity at a time across pages.
+        Unlike get_all, only the current page and the ones being 
+        prefetched (at least one) are held in memory.
+        kwargs passed to fetch; keys_only or projection make 
+        for much smaller results.
+        Stops after max_items entities, or before going over 
+        max_bytes of encoded entities.
+        """
+        prefetch = max(kwargs.pop('prefetch', None) or self.prefetch, 1)
+        count, size = 0, 0
+        for page_fut in self.get_by_page_async(prefetch=prefetch, **kwargs):
+            for item in page_fut.get_result():
+                if max_items is not None and count >= max_items:
+                    return
+                if max_bytes is not None:
+                    size += _encoded_size(item)
+                    if size > max_bytes:
+                        return
+                count += 1
+                yield item
+
     @ndb.tasklet
     def get_all_async(self, **kwargs):
         items = []
@@ -153,6 +325,107 @@ class QueryExec(object):
             items.extend(page)
         return items
 
+    def key_range(self, start=None, end=None):
+        """
+        A QueryExec over the part of this query where start <= key < end.
+        Either end may be None for open ended.
+        The query must not have inequality filters or sort orders 
+        on anything but the key.
+        """
+        query = self.query
+        if start is not None:
+            query = query.filter(ndb.Model._key >= start)
+        if end is not None:
+            query = query.filter(ndb.Model._key < end)
+        return QueryExec(query, batch_size=self.batch_size, prefetch=self.prefetch)
+
+    def split_points(self, n, oversampling=32):
+        """
+        Up to n-1 keys dividing the query into roughly even ranges.
+        Uses the __scatter__ property, which the datastore sets on 
+        a random sample of entities, to sample the key space.
+        The query may have an ancestor, which the sample keeps to 
+        (that needs an ancestor index on __scatter__), but no other 
+        filters: a sample cannot follow them.
+        """
+        if self.query.filters is not None:
+            raise ValueError('split needs a query with no filters but the ancestor')
+        if n < 2:
+            return []
+        sample_query = ndb.Query(kind=self.query.kind, 
+                ancestor=self.query.ancestor, 
+                namespace=self.query.namespace)
+        sample_query = sample_query.order(ndb.GenericProperty('__scatter__'))
+        samples = sorted(sample_query.fetch(n * oversampling, keys_only=True))
+        if len(samples) < n:
+            # too few to be picky; every sample is a boundary
+            return samples
+        step = len(samples) / float(n)
+        return sorted(set(samples[int(step * i)] for i in xrange(1, n)))
+
+    def split_at(self, keys):
+        """
+        Divides into len(keys) + 1 QueryExecs over disjoint key ranges.
+        """
+        bounds = [None] + sorted(keys) + [None]
+        return [self.key_range(start, end) for start, end in zip(bounds, bounds[1:])]
+
+    def split(self, n, oversampling=32):
+        """
+        Divides into up to n QueryExecs over disjoint key ranges 
+        that together cover the query, which may have an ancestor 
+        but no filters, see split_points. Each can be run as its own 
+        tasklet, e.g. map_async, or handed to a task as a pair of 
+        urlsafe keys and rebuilt with key_range.
+        """
+        return self.split_at(self.split_points(n, oversampling=oversampling))
+
+    def run_resumable(self, callback, url, cursor=None, checkpoint=None, 
+            time_budget=_TIME_BUDGET, params=None, task_options=None, **kwargs):
+        """
+        Calls callback with each page, starting from cursor 
+        (Cursor or urlsafe) or where the named checkpoint left off.
+        When more than time_budget seconds have been spent, a task 
+        to url is chained to carry on; the handler there calls this 
+        again. Without a checkpoint the task gets the cursor in params. 
+        With one, the cursor is saved to a Checkpoint after every 
+        page and the task resumes from that, so a task that dies 
+        is retried from its last page rather than from the start.
+        callback should be idempotent for that reason.
+        task_options passed to taskqueue, kwargs passed to fetch.
+        Returns the cursor carried on from, or None when done.
+        """
+        if isinstance(cursor, basestring):
+            cursor = ndb.Cursor(urlsafe=cursor)
+        state = None
+        if checkpoint is not None:
+            state = models.Checkpoint.get_or_insert(checkpoint)
+            if cursor is None:
+                if state.done:
+                    return None
+                cursor = ndb.Cursor(urlsafe=state.cursor) if state.cursor else None
+
+        start = time.time()
+        future = self.query.fetch_page_async(self.batch_size, start_cursor=cursor, **kwargs)
+        while True:
+            page, cursor, more = future.get_result()
+            if more: # fetch next page during callback
+                future = self.query.fetch_page_async(self.batch_size, start_cursor=cursor, **kwargs)
+            callback(page)
+            if state is not None:
+                state.cursor = cursor.urlsafe() if cursor else None
+                state.count += len(page)
+                state.done = not more
+                state.put()
+            if not more:
+                return None
+            if time.time() - start > time_budget:
+                params = dict(params or {})
+                if state is None:
+                    params['cursor'] = cursor.urlsafe()
+                safe_enqueue(url, params=params, **(task_options or {}))
+                return cursor
+
     def __iter__(self):
         """
         Return the generator as an iterator.
@@ -1,26 +1,128 @@
+import collections
+import datetime
 import hashlib
 import random
+import sys
+import threading
+import time
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
+from gaeutils import QueryExec
+
 
 DEFAULT_NUM_SHARDS = 10
-MAX_NUM_SHARDS = 30
+MAX_NUM_SHARDS = 250
 SHARD_KEY_TEMPLATE = 'shard-{}-{:d}'
 CACHE_COUNT_KEY = '_counters-{}'
 CACHE_LIFE = 60*5
+BUFFER_KEY = '_counters_buffer-{}'
+BUFFER_LOCK_KEY = '_counters_flush-{}'
+BUFFER_LOCK_LIFE = 30
+BUFFER_THRESHOLD = 100  # buffered amount that triggers a flush
+BUFFER_LIFE = 60        # seconds between flushes, per instance
+BUFFER_LOCAL_SIZE = 1000  # buffers whose last flush an instance remembers
+PENDING_KEY = '_counter_pending-{}'
+PENDING_LOCK_KEY = '_counter_flush-{}'
+CONFIG_CACHE_KEY = '_counters_config-{}'
+CONFIG_LOCAL_LIFE = 60    # seconds an instance trusts its own copy
+CONFIG_LOCAL_SIZE = 1000  # configs kept per instance
+CONTENTION_KEY = '_counters_contention-{}'
+CONTENTION_WINDOW = 60     # seconds collisions are counted over
+CONTENTION_THRESHOLD = 5   # collisions in the window that add shards
+CONTENTION_ATTEMPTS = 3    # shards tried before falling back to ndb retries
+WINDOW_RESOLUTIONS = {'minute': 60, 'hour': 60*60, 'day': 60*60*24} # bucket seconds
+WINDOW_KEEP = {'minute': 60*24, 'hour': 24*7, 'day': 90}            # buckets kept
+WINDOW_NUM_SHARDS = 5
+WINDOW_KEY_TEMPLATE = 'window-{}-{}-{:d}-{:d}'  # name, resolution, bucket start, index
+WINDOW_CACHE_KEY = '_counters_window-{}-{}-{:d}'
+
+# when this instance last flushed each buffer, by buffer key, least recent first
+_last_flush = collections.OrderedDict()
+_last_flush_lock = threading.Lock()
+# name -> (num_shards, expires), least recently used first
+_config_cache = collections.OrderedDict()
+# request threads share the module; guards _config_cache
+_config_lock = threading.Lock()
 
 
 class ShardConfig(ndb.Model):
     """Tracks the number of shards for each named counter."""
     num_shards = ndb.IntegerProperty(default=DEFAULT_NUM_SHARDS)
 
+    @classmethod
+    @ndb.tasklet
+    def get_num_shards_async(cls, name, use_local=True):
+        """Number of shards for the counter name.
+
+        Cached in this instance for CONFIG_LOCAL_LIFE and in memcache.
+        An instance may go on using a smaller number for that long after
+        increase_shards, which is harmless for writes. Reads that must
+        see every shard pass use_local=False.
+        """
+        now = time.time()
+        if use_local:
+            with _config_lock:
+                cached = _config_cache.pop(name, None)
+                if cached is not None and cached[1] > now:
+                    _config_cache[name] = cached # now most recently used
+            if cached is not None and cached[1] > now:
+                raise ndb.Return(cached[0])
+        ctx = ndb.get_context()
+        cache_key = CONFIG_CACHE_KEY.format(name)
+        num_shards = yield ctx.memcache_get(cache_key)
+        if num_shards is None:
+            config = yield cls.get_or_insert_async(name)
+            num_shards = config.num_shards
+            # add, not set, so an older read never replaces what increase_shards set
+            yield ctx.memcache_add(cache_key, num_shards, CACHE_LIFE)
+        with _config_lock:
+            _config_cache.pop(name, None)
+            _config_cache[name] = (num_shards, now + CONFIG_LOCAL_LIFE)
+            while len(_config_cache) > CONFIG_LOCAL_SIZE:
+                _config_cache.popitem(last=False)
+        raise ndb.Return(num_shards)
+
+    @classmethod
+    def get_num_shards(cls, name, use_local=True):
+        return cls.get_num_shards_async(name, use_local=use_local).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_num_shards_multi_async(cls, names):
+        """Number of shards for each of names, as a dict.
+
+        Like get_num_shards with use_local=False, but with one memcache
+        call and at most one datastore call for all of them. A counter
+        without a config has DEFAULT_NUM_SHARDS.
+        """
+        client = memcache.Client()
+        cache_keys = dict((name, CONFIG_CACHE_KEY.format(name)) for name in names)
+        cached = yield client.get_multi_async(cache_keys.values())
+        result = dict((name, cached[cache_keys[name]]) for name in names 
+                if cache_keys[name] in cached)
+        missing = [name for name in names if name not in result]
+        if missing:
+            configs = yield ndb.get_multi_async([ndb.Key(cls, name) for name in missing])
+            for name, config in zip(missing, configs):
+                result[name] = config.num_shards if config else DEFAULT_NUM_SHARDS
+            yield client.add_multi_async(dict((cache_keys[name], result[name]) for name in missing), 
+                    time=CACHE_LIFE)
+        raise ndb.Return(result)
+
+    @classmethod
+    def get_num_shards_multi(cls, names):
+        return cls.get_num_shards_multi_async(names).get_result()
+
     @classmethod
     def all_keys(cls, name):
         """Returns all possible keys for the counter name given the config."""
-        config = cls.get_or_insert(name)
-        shard_keys = [CounterShard.gen_key(name, x) for x in range(config.num_shards)]
+        num_shards = cls.get_num_shards(name, use_local=False)
+        shard_keys = [CounterShard.gen_key(name, x) for x in range(num_shards)]
         return shard_keys
 
 class CounterShard(ndb.Model):
@@ -37,50 +139,396 @@ class CounterShard(ndb.Model):
         return cls.gen_key(name, index)
 
 
+@ndb.tasklet
+def get_count_async(name, use_cache=True, cache_life=CACHE_LIFE):
+    """Retrieve the value for a given sharded counter.
+
+    Includes any amount buffered by increment that is not flushed yet.
+    """
+    counts = yield get_counts_async([name], use_cache=use_cache, cache_life=cache_life)
+    raise ndb.Return(counts[name])
+
+
 def get_count(name, use_cache=True, cache_life=CACHE_LIFE):
-    """Retrieve the value for a given sharded counter."""
-    cache_key = CACHE_COUNT_KEY.format(name)
-    total = memcache.get(cache_key) if use_cache else None
-    if total is None:
-        total = 0
-        all_keys = ShardConfig.all_keys(name)
-        for counter in ndb.get_multi(all_keys):
+    return get_count_async(name, use_cache=use_cache, cache_life=cache_life).get_result()
+
+
+@ndb.tasklet
+def get_counts_async(names, use_cache=True, cache_life=CACHE_LIFE):
+    """Retrieve the values for many sharded counters as a dict of name to value.
+
+    One memcache call covers the cached totals, then one datastore
+    call covers the shards of every counter that was not cached.
+    """
+    client = memcache.Client()
+    names = list(set(names))
+    cache_keys = dict((name, CACHE_COUNT_KEY.format(name)) for name in names)
+    buffer_keys = dict((name, BUFFER_KEY.format(name)) for name in names)
+    lookup = buffer_keys.values()
+    if use_cache:
+        lookup += cache_keys.values()
+    cached = yield client.get_multi_async(lookup)
+
+    totals = {}
+    if use_cache:
+        totals = dict((name, cached[cache_keys[name]]) for name in names 
+                if cache_keys[name] in cached)
+    missing = [name for name in names if name not in totals]
+    if missing:
+        num_shards = yield ShardConfig.get_num_shards_multi_async(missing)
+        shard_names = [name for name in missing for x in range(num_shards[name])]
+        shard_keys = [CounterShard.gen_key(name, x) 
+                for name in missing for x in range(num_shards[name])]
+        for name in missing:
+            totals[name] = 0
+        counters = yield ndb.get_multi_async(shard_keys)
+        for name, counter in zip(shard_names, counters):
             if counter is not None:
-                total += counter.count
+                totals[name] += counter.count
         if use_cache:
-            memcache.add(cache_key, total, cache_life)
-    return total
+            yield client.add_multi_async(dict((cache_keys[name], totals[name]) for name in missing), 
+                    time=cache_life)
+    raise ndb.Return(dict((name, totals[name] + int(cached.get(buffer_keys[name]) or 0)) 
+            for name in names))
+
+
+def get_counts(names, use_cache=True, cache_life=CACHE_LIFE):
+    return get_counts_async(names, use_cache=use_cache, cache_life=cache_life).get_result()
+
+
+@ndb.tasklet
+def increment_async(name, delta=1, buffered=False):
+    """Increment the value for a given sharded counter.
+
+    buffered accumulates delta in memcache instead, at the cost of one
+    memcache call. It is written to the shards by flush once
+    BUFFER_THRESHOLD has built up, or when this instance has not
+    flushed it for BUFFER_LIFE seconds; failing that, by a deferred
+    task queued when the buffer starts filling. A memcache eviction loses
+    whatever was waiting, so use it for counters that can afford that.
+    Negative deltas are never buffered.
+    """
+    yield increment_multi_async({name: delta}, buffered=buffered)
+
+
+def increment(name, delta=1, buffered=False):
+    increment_async(name, delta=delta, buffered=buffered).get_result()
+
+
+@ndb.tasklet
+def increment_multi_async(deltas, buffered=False):
+    """Increment many sharded counters, given a dict of name to delta.
+
+    Buffered deltas go to memcache in one call. The rest run their
+    shard transactions side by side.
+    """
+    deltas = dict(deltas)
+    flushes = []
+    if buffered:
+        buffer_keys = dict((BUFFER_KEY.format(name), name) 
+                for name, delta in deltas.iteritems() if delta > 0)
+        offsets = dict((key, deltas[name]) for key, name in buffer_keys.iteritems())
+        pending = {}
+        if offsets:
+            pending = yield memcache.Client().offset_multi_async(offsets, initial_value=0)
+        for key, value in pending.iteritems():
+            if value is None:
+                continue # memcache unavailable, write straight through
+            name = buffer_keys[key]
+            del deltas[name]
+            if _should_flush(key, value):
+                flushes.append(flush_async(name))
+            elif value == offsets[key]:
+                _schedule_flush(key, flush, name)
+    names = deltas.keys()
+    num_shards = yield [ShardConfig.get_num_shards_async(name) for name in names]
+    yield flushes + [_increment_async(name, shards, delta=deltas[name]) 
+            for name, shards in zip(names, num_shards)]
+
+
+def increment_multi(deltas, buffered=False):
+    increment_multi_async(deltas, buffered=buffered).get_result()
+
+
+@ndb.tasklet
+def flush_async(name):
+    """Write the amount buffered for a counter to one of its shards.
+
+    Only one flush per counter runs at a time; returns the amount
+    written, 0 if nothing was or another flush is running.
+    """
+    @ndb.tasklet
+    def write(pending):
+        num_shards = yield ShardConfig.get_num_shards_async(name)
+        yield _increment_async(name, num_shards, delta=pending)
+    flushed = yield _drain_async(BUFFER_KEY.format(name), BUFFER_LOCK_KEY.format(name), write)
+    raise ndb.Return(flushed)
 
 
-def increment(name, delta=1):
-    """Increment the value for a given sharded counter."""
-    config = ShardConfig.get_or_insert(name)
-    _increment(name, config.num_shards, delta=delta)
+@ndb.tasklet
+def _drain_async(buffer_key, lock_key, write):
+    """Hands the amount waiting in a memcache buffer to write.
+
+    write is a tasklet taking the amount. A memcache lock keeps drains
+    of one buffer from overlapping; if write fails the amount goes back.
+    """
+    ctx = ndb.get_context()
+    locked = yield ctx.memcache_add(lock_key, 1, BUFFER_LOCK_LIFE)
+    if not locked:
+        raise ndb.Return(0)
+    _flushed(buffer_key, time.time())
+    error = None
+    try:
+        pending = yield ctx.memcache_get(buffer_key)
+        pending = int(pending or 0)
+        if pending > 0:
+            # decr only what was read; increments since then stay buffered
+            yield ctx.memcache_decr(buffer_key, delta=pending)
+            try:
+                yield write(pending)
+            except Exception:
+                error = sys.exc_info()
+                # put it back for the next flush
+                yield ctx.memcache_incr(buffer_key, delta=pending, initial_value=0)
+    except Exception:
+        error = error or sys.exc_info()
+    yield ctx.memcache_delete(lock_key)
+    if error is not None:
+        raise error[0], error[1], error[2]
+    raise ndb.Return(pending)
+
+
+def _flushed(buffer_key, when=None):
+    """When this instance last flushed buffer_key; records when if given."""
+    with _last_flush_lock:
+        last_flush = _last_flush.pop(buffer_key, None)
+        if when is not None or last_flush is None:
+            last_flush = when or time.time()
+        _last_flush[buffer_key] = last_flush
+        while len(_last_flush) > BUFFER_LOCAL_SIZE:
+            _last_flush.popitem(last=False)
+    return last_flush
 
 
-@ndb.transactional
-def _increment(name, num_shards, delta=1):
-    """Transactional helper to increment the value for a given sharded counter."""
+def _should_flush(buffer_key, pending):
+    """Whether a buffer has built up enough, or waited long enough, to flush."""
+    return pending >= BUFFER_THRESHOLD or time.time() - _flushed(buffer_key) >= BUFFER_LIFE
+
+
+def _schedule_flush(buffer_key, flush_func, *args):
+    """Flush in BUFFER_LIFE even if no increment comes along to do it.
+
+    Called when a buffer starts filling; the task name, per buffer and
+    interval, makes the rest no-ops.
+    """
+    slot = int(time.time() / BUFFER_LIFE)
+    name = 'counter-flush-%s-%d' % (hashlib.md5(buffer_key).hexdigest(), slot)
+    try:
+        deferred.defer(flush_func, *args, _name=name, _countdown=BUFFER_LIFE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def flush(name):
+    return flush_async(name).get_result()
+
+
+@ndb.tasklet
+def _increment_async(name, num_shards, delta=1):
+    """Helper to increment the value for a given sharded counter.
+
+    A transaction that collides is not retried on the same shard;
+    another random shard is tried instead and the collision is
+    recorded, which adds shards once a counter is running hot.
+    """
+    txn = lambda: _increment_shard_async(name, num_shards, delta)
+    if ndb.in_transaction():
+        yield txn() # part of the caller's transaction
+    else:
+        for attempt in range(CONTENTION_ATTEMPTS):
+            try:
+                yield ndb.transaction_async(txn, retries=0)
+                break
+            except datastore_errors.TransactionFailedError:
+                yield _record_contention_async(name, num_shards)
+        else:
+            yield ndb.transaction_async(txn)
+    # Memcache offset does nothing if the name is not a key in memcache;
+    # unlike incr it takes negative deltas
+    yield memcache.Client().offset_multi_async({CACHE_COUNT_KEY.format(name): delta})
+
+
+@ndb.tasklet
+def _increment_shard_async(name, num_shards, delta):
+    """Transactional part of _increment_async."""
     key = CounterShard.gen_random_key(name, num_shards)
-    counter = key.get()
+    counter = yield key.get_async()
     if counter is None:
         counter = CounterShard(key=key)
     counter.count += delta
-    counter.put()
-    # Memcache increment does nothing if the name is not a key in memcache
-    memcache.incr(CACHE_COUNT_KEY.format(name), delta=delta)
+    yield counter.put_async()
 
 
-@ndb.transactional
-def increase_shards(name, num_shards):
+@ndb.tasklet
+def _record_contention_async(name, num_shards):
+    """Counts a collision; doubles the shards when there are too many."""
+    ctx = ndb.get_context()
+    contention_key = CONTENTION_KEY.format(name)
+    yield ctx.memcache_add(contention_key, 0, CONTENTION_WINDOW)
+    collisions = yield ctx.memcache_incr(contention_key)
+    if collisions is not None and collisions >= CONTENTION_THRESHOLD:
+        yield ctx.memcache_delete(contention_key)
+        yield increase_shards_async(name, min(num_shards * 2, MAX_NUM_SHARDS))
+
+
+def _record_contention(name, num_shards):
+    _record_contention_async(name, num_shards).get_result()
+
+
+@ndb.tasklet
+def increase_shards_async(name, num_shards):
     """Increase the number of shards for a given sharded counter.
 
     Will never decrease the number of shards.
     """
-    config = ShardConfig.get_or_insert(name)
+    num_shards = yield ndb.transaction_async(lambda: _increase_shards_async(name, num_shards), 
+            propagation=ndb.TransactionOptions.ALLOWED)
+    yield ndb.get_context().memcache_set(CONFIG_CACHE_KEY.format(name), num_shards, CACHE_LIFE)
+    with _config_lock:
+        _config_cache.pop(name, None)
+
+
+def increase_shards(name, num_shards):
+    increase_shards_async(name, num_shards).get_result()
+
+
+@ndb.tasklet
+def _increase_shards_async(name, num_shards):
+    """Transactional part of increase_shards; returns the resulting number."""
+    config = yield ShardConfig.get_or_insert_async(name)
     if config.num_shards < num_shards and num_shards <= MAX_NUM_SHARDS:
         config.num_shards = num_shards
-        config.put()
+        yield config.put_async()
+    raise ndb.Return(config.num_shards)
+
+class WindowShard(ndb.Model):
+    """Shards for one time bucket of a windowed counter.
+
+    Only shards that were written exist, and each one
+    expires once its bucket is older than WINDOW_KEEP.
+    """
+    count   = ndb.IntegerProperty(default=0, indexed=False)
+    expires = ndb.DateTimeProperty()
+
+    @classmethod
+    def gen_key(cls, name, resolution, start, index):
+        return ndb.Key(cls, WINDOW_KEY_TEMPLATE.format(name, resolution, start, index))
+
+
+def _bucket_starts(resolution, buckets, now=None):
+    """Start times, newest first, of the last buckets buckets up to now."""
+    seconds = WINDOW_RESOLUTIONS[resolution]
+    now = int(now if now is not None else time.time())
+    current = now // seconds * seconds
+    return [current - seconds * i for i in range(buckets)]
+
+
+@ndb.tasklet
+def increment_window_async(name, delta=1, resolutions=None, now=None):
+    """Increment the current bucket of a windowed counter at each resolution.
+
+    resolutions defaults to all of WINDOW_RESOLUTIONS. The buckets are
+    separate entity groups, so their transactions run side by side;
+    in a caller's transaction, which needs to be xg, they join it.
+    """
+    resolutions = resolutions or WINDOW_RESOLUTIONS.keys()
+    now = now if now is not None else time.time()
+    starts = dict((resolution, _bucket_starts(resolution, 1, now)[0]) 
+            for resolution in resolutions)
+    yield [ndb.transaction_async(_window_txn(name, resolution, start, delta), 
+            propagation=ndb.TransactionOptions.ALLOWED) 
+            for resolution, start in starts.iteritems()]
+    yield memcache.Client().offset_multi_async(dict(
+        (WINDOW_CACHE_KEY.format(name, resolution, start), delta) 
+        for resolution, start in starts.iteritems()))
+
+
+def increment_window(name, delta=1, resolutions=None, now=None):
+    increment_window_async(name, delta=delta, resolutions=resolutions, now=now).get_result()
+
+
+def _window_txn(name, resolution, start, delta):
+    @ndb.tasklet
+    def txn():
+        key = WindowShard.gen_key(name, resolution, start, 
+                random.randint(0, WINDOW_NUM_SHARDS - 1))
+        shard = yield key.get_async()
+        if shard is None:
+            end = start + WINDOW_RESOLUTIONS[resolution] * (WINDOW_KEEP[resolution] + 1)
+            shard = WindowShard(key=key, expires=datetime.datetime.utcfromtimestamp(end))
+        shard.count += delta
+        yield shard.put_async()
+    return txn
+
+
+@ndb.tasklet
+def get_window_counts_async(name, resolution='minute', buckets=1, now=None):
+    """Counts for the last buckets buckets, newest first, as (start, count) pairs.
+
+    The current bucket is included. Bucket totals are cached; a
+    closed bucket does not change so it is cached for longer.
+    """
+    client = memcache.Client()
+    starts = _bucket_starts(resolution, buckets, now)
+    cache_keys = dict((start, WINDOW_CACHE_KEY.format(name, resolution, start)) for start in starts)
+    cached = yield client.get_multi_async(cache_keys.values())
+    totals = dict((start, cached[cache_keys[start]]) for start in starts 
+            if cache_keys[start] in cached)
+    missing = [start for start in starts if start not in totals]
+    if missing:
+        shard_starts = [start for start in missing for x in range(WINDOW_NUM_SHARDS)]
+        shard_keys = [WindowShard.gen_key(name, resolution, start, x) 
+                for start in missing for x in range(WINDOW_NUM_SHARDS)]
+        for start in missing:
+            totals[start] = 0
+        shards = yield ndb.get_multi_async(shard_keys)
+        for start, shard in zip(shard_starts, shards):
+            if shard is not None:
+                totals[start] += shard.count
+        current, closed = starts[0], [start for start in missing if start != starts[0]]
+        if current in missing:
+            yield client.add_multi_async({cache_keys[current]: totals[current]}, 
+                    time=min(CACHE_LIFE, WINDOW_RESOLUTIONS[resolution]))
+        if closed:
+            yield client.add_multi_async(dict((cache_keys[start], totals[start]) for start in closed), 
+                    time=max(CACHE_LIFE, WINDOW_RESOLUTIONS[resolution]))
+    raise ndb.Return([(start, totals[start]) for start in starts])
+
+
+def get_window_counts(name, resolution='minute', buckets=1, now=None):
+    return get_window_counts_async(name, resolution=resolution, buckets=buckets, now=now).get_result()
+
+
+@ndb.tasklet
+def get_window_count_async(name, resolution='minute', buckets=1, now=None):
+    """Total over a rolling window, e.g. the last 15 minutes is ('minute', 15)."""
+    counts = yield get_window_counts_async(name, resolution=resolution, buckets=buckets, now=now)
+    raise ndb.Return(sum(count for start, count in counts))
+
+
+def get_window_count(name, resolution='minute', buckets=1, now=None):
+    return get_window_count_async(name, resolution=resolution, buckets=buckets, now=now).get_result()
+
+
+def purge_windows(batch_size=500):
+    """Delete expired window shards, e.g. from a cron job; returns how many."""
+    query = WindowShard.query(WindowShard.expires < datetime.datetime.utcnow())
+    deleted = 0
+    for keys in QueryExec(query, batch_size=batch_size).get_by_page(keys_only=True):
+        ndb.delete_multi(keys)
+        deleted += len(keys)
+    return deleted
+
 
 class Counter(ndb.Model):
     """
@@ -108,33 +556,129 @@ class Counter(ndb.Model):
         return ndb.Key(cls, _key.hexdigest())
 
     @classmethod
-    @ndb.transactional
+    def get_async(cls, name, domain=None):
+        # a get by key is consistent, and part of any current transaction
+        return cls.gen_key(name, domain=domain).get_async()
+
+    @classmethod
     def get(cls, name, domain=None):
-        key = cls.gen_key(name, domain=domain)
-        return key.get()
+        return cls.get_async(name, domain=domain).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_or_create_async(cls, name, domain=None):
+        @ndb.tasklet
+        def txn():
+            key = cls.gen_key(name, domain=domain)
+            counter = yield key.get_async()
+            if counter is None:
+                counter = cls(key=key, name=name, domain=domain)
+                yield counter.put_async()
+            raise ndb.Return(counter)
+        counter = yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.ALLOWED)
+        raise ndb.Return(counter)
 
     @classmethod
-    @ndb.transactional
     def get_or_create(cls, name, domain=None):
-        counter = cls.get(name=name, domain=domain)
-        if counter is None:
-            counter = cls(key=cls.gen_key(name=name, domain=domain), 
-                    name=name)
-            if domain is not None:
-                counter.domain = domain
-            counter.put()
-        return counter
+        return cls.get_or_create_async(name, domain=domain).get_result()
 
     @classmethod
-    @ndb.transactional
-    def increment(cls, name, domain=None, delta=1):
-        counter = cls.get_or_create(name, domain=domain)
-        counter.count += delta
-        counter.put()
+    @ndb.tasklet
+    def increment_async(cls, name, domain=None, delta=1, approximate=False):
+        """One transaction that reads the counter and creates or updates it.
+
+        approximate skips the transaction and adds delta in memcache,
+        persisted by flush the same way buffered sharded counters are,
+        including the deferred flush for counters that go quiet.
+        It shows in count only once flushed, and a memcache eviction
+        loses it. Negative deltas are never approximate.
+        """
+        if approximate and delta > 0:
+            pending_key = PENDING_KEY.format(cls.gen_key(name, domain=domain).id())
+            pending = yield ndb.get_context().memcache_incr(pending_key, delta=delta, initial_value=0)
+            if pending is not None:
+                if _should_flush(pending_key, pending):
+                    yield cls.flush_async(name, domain=domain)
+                elif pending == delta:
+                    _schedule_flush(pending_key, _flush_counter, cls, name, domain)
+                return
+            # memcache unavailable, fall through to the transaction
+        counter = yield cls._add_async(name, domain, lambda counter: counter.count + delta)
+        raise ndb.Return(counter)
+
+    @classmethod
+    def increment(cls, name, domain=None, delta=1, approximate=False):
+        cls.increment_async(name, domain=domain, delta=delta, approximate=approximate).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def flush_async(cls, name, domain=None):
+        """Persist what approximate increments have added; returns the amount."""
+        key_id = cls.gen_key(name, domain=domain).id()
+        write = lambda pending: cls._add_async(name, domain, lambda counter: counter.count + pending)
+        flushed = yield _drain_async(PENDING_KEY.format(key_id), PENDING_LOCK_KEY.format(key_id), write)
+        raise ndb.Return(flushed)
+
+    @classmethod
+    def flush(cls, name, domain=None):
+        return cls.flush_async(name, domain=domain).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def set_async(cls, name, domain=None, value=0):
+        counter = yield cls._add_async(name, domain, lambda counter: value)
+        raise ndb.Return(counter)
 
     @classmethod
-    @ndb.transactional
     def set(cls, name, domain=None, value=0):
-        counter = cls.get_or_create(name, domain=domain)
-        counter.count = value
-        counter.put()
+        cls.set_async(name, domain=domain, value=value).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def _add_async(cls, name, domain, new_count):
+        """
+        Transaction with a single get, then a single put that 
+        creates the counter or updates it to new_count(counter).
+        """
+        @ndb.tasklet
+        def txn():
+            key = cls.gen_key(name, domain=domain)
+            counter = yield key.get_async()
+            if counter is None:
+                counter = cls(key=key, name=name, domain=domain)
+            counter.count = new_count(counter)
+            yield counter.put_async()
+            raise ndb.Return(counter)
+        counter = yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.ALLOWED)
+        raise ndb.Return(counter)
+
+    @classmethod
+    @ndb.tasklet
+    def get_counts_async(cls, names, domain=None):
+        """Values of many counters in one datastore call, as a dict of name to count."""
+        counters = yield ndb.get_multi_async([cls.gen_key(name, domain=domain) for name in names])
+        raise ndb.Return(dict((name, counter.count if counter is not None else 0) 
+                for name, counter in zip(names, counters)))
+
+    @classmethod
+    def get_counts(cls, names, domain=None):
+        return cls.get_counts_async(names, domain=domain).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def increment_multi_async(cls, deltas, domain=None):
+        """Increment many counters, given a dict of name to delta.
+
+        Each counter is its own transaction; they run side by side.
+        """
+        yield [cls.increment_async(name, domain=domain, delta=delta) 
+                for name, delta in deltas.iteritems()]
+
+    @classmethod
+    def increment_multi(cls, deltas, domain=None):
+        cls.increment_multi_async(deltas, domain=domain).get_result()
+
+
+def _flush_counter(model_class, name, domain):
+    """Deferred flush of approximate Counter increments."""
+    model_class.flush(name, domain=domain)
@@ -1 +1,4 @@
 from .models import Subscription
+from .models import work_subscribers, work_pull_queue, PAYLOAD_KEYS, PAYLOAD_COMPACT, PAYLOAD_SHARD
+from .jobs import FanoutJob
+from .throttle import Throttle
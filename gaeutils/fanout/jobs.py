@@ -0,0 +1,126 @@
+import datetime
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from gaeutils import counters, safe_enqueue
+
+_COUNTER_TEMPLATE = 'fanout-{}-{}' # job_id, what
+_EXPECTED_KEY = '_fanout_expected-{}'
+_DONE_KEY = '_fanout_done-{}' # job_id; shards done, kept atomically
+_RECORDED_KEY = '_fanout_recorded-{}-{}' # job_id, shard; counted once
+_EXPECTED_LIFE = 60*60*24
+_UNTRACKED = -1
+
+class FanoutJob(ndb.Model):
+    """
+    Progress of one fanout, keyed by job_id.
+    Work handlers call record as each shard's work is done. 
+    Completion is counted with sharded counters so it survives 
+    memcache, and the optional completion_url gets exactly 
+    one task once every shard that existed at start is done.
+    Shards subscribe adds while the job runs get work too and are 
+    counted with the rest, so they can complete a job early; 
+    subscribe_later holds new subscribers back until its merge.
+    """
+    subscription         = ndb.KeyProperty()
+    started              = ndb.DateTimeProperty(auto_now_add=True)
+    completed            = ndb.DateTimeProperty()
+    expected_shards      = ndb.IntegerProperty(default=0, indexed=False)
+    expected_subscribers = ndb.IntegerProperty(default=0, indexed=False)
+    completion_url       = ndb.StringProperty(indexed=False)
+
+    @staticmethod
+    def _counter_names(job_id):
+        return (_COUNTER_TEMPLATE.format(job_id, 'shards'), 
+                _COUNTER_TEMPLATE.format(job_id, 'subscribers'))
+
+    @classmethod
+    def start(cls, job_id, subscription, expected_shards, expected_subscribers, completion_url=None):
+        job = cls(id=job_id, 
+                subscription=subscription, 
+                expected_shards=expected_shards, 
+                expected_subscribers=expected_subscribers, 
+                completion_url=completion_url)
+        job.put()
+        memcache.set_multi({_EXPECTED_KEY.format(job_id): expected_shards, 
+                _DONE_KEY.format(job_id): 0}, time=_EXPECTED_LIFE)
+        if expected_shards == 0:
+            cls._complete(job_id)
+        return job
+
+    @classmethod
+    def record(cls, job_id, shard, subscribers):
+        """
+        Call from the work handler once the work for a shard, 
+        the subscriber_keys of one task, is done. shard is the 
+        task's shard param; a shard recorded again, by a retried 
+        task, is not counted again, unless memcache has lost its marker.
+        """
+        cls.record_multi(job_id, {shard: subscribers})
+
+    @classmethod
+    def record_multi(cls, job_id, done):
+        """ record for many shards at once, given a dict of shard to subscribers. """
+        expected_key = _EXPECTED_KEY.format(job_id)
+        expected = memcache.get(expected_key)
+        if expected is None:
+            job = cls.get_by_id(job_id)
+            # jobs start before their first task, so this stays true
+            expected = job.expected_shards if job is not None else _UNTRACKED
+            memcache.set(expected_key, expected, _EXPECTED_LIFE)
+        if expected == _UNTRACKED:
+            return
+        done = dict((shard.urlsafe() if isinstance(shard, ndb.Key) else shard, subscribers) 
+                for shard, subscribers in done.iteritems())
+        # only shards whose marker goes in are new to the count
+        markers = dict((_RECORDED_KEY.format(job_id, hashlib.md5(shard).hexdigest()), shard) 
+                for shard in done)
+        refused = memcache.add_multi(dict((key, 1) for key in markers), time=_EXPECTED_LIFE)
+        fresh = [shard for key, shard in markers.iteritems() if key not in refused]
+        if not fresh:
+            return
+        shards_name, subscribers_name = cls._counter_names(job_id)
+        counters.increment_multi({shards_name: len(fresh), 
+                subscribers_name: sum(done[shard] for shard in fresh)})
+        # incr is atomic, so exactly one record sees the total reach expected;
+        # it comes after every other record's counter commit
+        count = memcache.incr(_DONE_KEY.format(job_id), len(fresh))
+        if count is not None and count < expected:
+            return
+        # reached, or memcache lost count; the counter shards have the final say
+        if counters.get_count(shards_name, use_cache=False) >= expected:
+            # the transaction makes sure it happens once
+            cls._complete(job_id)
+
+    @classmethod
+    @ndb.transactional
+    def _complete(cls, job_id):
+        job = cls.get_by_id(job_id)
+        if job is None or job.completed is not None:
+            return
+        job.completed = datetime.datetime.utcnow()
+        job.put()
+        if job.completion_url:
+            safe_enqueue(job.completion_url, 
+                    params=dict(job_id=job_id, subscription=job.subscription.urlsafe()), 
+                    transactional=True)
+
+    def stats(self):
+        """
+        Progress, elapsed seconds and subscribers per second, so far 
+        or, once completed, up to the last delivery.
+        """
+        names = self._counter_names(self.key.id())
+        counts = counters.get_counts(names)
+        done_shards, done_subscribers = [counts[name] for name in names]
+        end = self.completed or datetime.datetime.utcnow()
+        elapsed = (end - self.started).total_seconds()
+        return dict(shards=done_shards, 
+                expected_shards=self.expected_shards, 
+                subscribers=done_subscribers, 
+                expected_subscribers=self.expected_subscribers, 
+                completed=self.completed is not None, 
+                elapsed=elapsed, 
+                per_second=done_subscribers / elapsed if elapsed > 0 else 0.0)
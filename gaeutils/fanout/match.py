@@ -0,0 +1,149 @@
+import time
+import threading
+import collections
+
+from google.appengine.api import memcache
+
+from gaeutils import QueryExec
+
+_VERSION_KEY = '_fanout_match-{}' # kind
+_LOCAL_LIFE = 5*60       # seconds an index is trusted even if the version stays put
+_REBUILD_INTERVAL = 60   # seconds at least between rebuilds of an index
+
+_indexes = {} # kind -> [MatchIndex, version, built]
+_indexes_lock = threading.Lock() # serializes changes; readers never wait
+
+class MatchIndex(object):
+    """
+    In memory index of the subscriptions of one kind by their match fields.
+    Per field, a dict of value to subscription keys, and the keys 
+    of subscriptions that leave the field empty, which match anything.
+    Repeated values match if any one does.
+    An index may be matched by other threads, so once cached it is 
+    not changed; changed() applies a change to a copy.
+    """
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.by_value = dict((field, collections.defaultdict(set)) for field in self.fields)
+        self.wildcards = dict((field, set()) for field in self.fields)
+        self.entries = {} # key -> {field: values}, to take it back out
+
+    def copy(self):
+        index = MatchIndex(self.fields)
+        for field in self.fields:
+            index.by_value[field].update((value, set(keys)) 
+                    for value, keys in self.by_value[field].iteritems())
+            index.wildcards[field].update(self.wildcards[field])
+        index.entries.update(self.entries) # entries are never changed in place
+        return index
+
+    @property
+    def keys(self):
+        return self.entries.viewkeys()
+
+    def add(self, subscription):
+        self.remove(subscription.key)
+        entry = self.entries[subscription.key] = {}
+        for field in self.fields:
+            values = entry[field] = _values(getattr(subscription, field, None))
+            if not values:
+                self.wildcards[field].add(subscription.key)
+            for value in values:
+                self.by_value[field][value].add(subscription.key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for field, values in entry.iteritems():
+            self.wildcards[field].discard(key)
+            for value in values:
+                keys = self.by_value[field].get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.by_value[field][value]
+
+    def match(self, event):
+        """ Keys of the subscriptions whose every field matches event, a dict. """
+        candidates = []
+        for field in self.fields:
+            keys = set(self.wildcards[field])
+            for value in _values(event.get(field)):
+                keys.update(self.by_value[field].get(value, ()))
+            candidates.append(keys)
+        if not candidates:
+            return set(self.keys)
+        # smallest first keeps the intersection cheap
+        candidates.sort(key=len)
+        matched = candidates[0]
+        for keys in candidates[1:]:
+            matched = matched & keys
+            if not matched:
+                break
+        return matched
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [v for v in value if v is not None]
+    return [value]
+
+def version(kind):
+    key = _VERSION_KEY.format(kind)
+    current = memcache.get(key)
+    if current is None:
+        # evicted; a new version makes every instance rebuild
+        memcache.add(key, int(time.time() * 1000))
+        current = memcache.get(key)
+    return current
+
+def changed(subscription=None, kind=None, key=None):
+    """
+    A subscription was put, or the one with key deleted. The index in 
+    this instance takes the change straight away, on a copy swapped 
+    in for the cached one; other instances see a new version and 
+    rebuild, no more than every _REBUILD_INTERVAL.
+    """
+    kind = kind or subscription._get_kind()
+    new_version = memcache.incr(_VERSION_KEY.format(kind), initial_value=int(time.time() * 1000))
+    with _indexes_lock:
+        cached = _indexes.get(kind)
+        if cached is None:
+            return
+        index, built_version, built = cached
+        index = index.copy()
+        if subscription is not None:
+            index.add(subscription)
+        else:
+            index.remove(key)
+        if new_version is not None and new_version == built_version + 1:
+            # nobody else changed anything, so this index is current
+            built_version = new_version
+        _indexes[kind] = [index, built_version, built]
+
+def get_index(model_class, batch_size=1000):
+    """
+    The index for model_class, cached in this instance. It is built 
+    from a full read of the subscriptions when this instance has 
+    none, or when memcache has a newer version and the index is 
+    over _REBUILD_INTERVAL old, so a steady stream of new 
+    subscriptions does not mean a full read per match.
+    """
+    kind = model_class._get_kind()
+    current = version(kind)
+    cached = _indexes.get(kind)
+    now = time.time()
+    if cached is not None:
+        index, built_version, built = cached
+        if index.fields == tuple(model_class.match_fields):
+            if built_version == current and built + _LOCAL_LIFE > now:
+                return index
+            if built + _REBUILD_INTERVAL > now:
+                return index # a little stale, rebuilt soon
+    index = MatchIndex(model_class.match_fields)
+    for subscription in QueryExec(model_class.query(), batch_size=batch_size).iter_entities():
+        index.add(subscription)
+    _indexes[kind] = [index, current, now]
+    return index
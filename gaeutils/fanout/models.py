@@ -1,14 +1,41 @@
 import uuid
+import time
+import zlib
+import json
 import base64
+import hashlib
+import heapq
+import itertools
+import collections
 
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext import deferred
 
-from gaeutils import safe_enqueue
+from gaeutils import safe_enqueue, safe_enqueue_batch, QueryExec
+from gaeutils.fanout.jobs import FanoutJob
+from gaeutils.fanout.throttle import Throttle
+from gaeutils.fanout import match
 
 _SHARD_SIZE = 100          # subscribers per shard; this is like batch size
 _SHARD_CHILDREN_LIMIT = 3  # limit children of shard
+_MERGE_INTERVAL = 10       # seconds pending subscribers wait to be merged
+
+_QUEUE_OPTIONS = ('queue_name', 'transactional')
+
+# how subscribers reach the work task
+PAYLOAD_KEYS = 'keys'       # subscriber_keys, a urlsafe key each
+PAYLOAD_COMPACT = 'compact' # subscribers, see encode_subscribers
+PAYLOAD_SHARD = 'shard'     # only the shard; the worker reads it
+
+def _split_options(kwargs):
+    """
+    Splits kwargs meant for taskqueue.add into 
+    those for the Task and those for the Queue.
+    """
+    task_kwargs = dict((k, v) for k, v in kwargs.iteritems() if k not in _QUEUE_OPTIONS)
+    queue_kwargs = dict((k, v) for k, v in kwargs.iteritems() if k in _QUEUE_OPTIONS)
+    return task_kwargs, queue_kwargs
 
 class Shard(ndb.Model):
     """
@@ -39,31 +66,49 @@ class Shard(ndb.Model):
         # subscription is the top parent
         return ndb.Key(pairs=[ self.key.pairs()[0] ])
 
-    def do_work(self, shard_url, work_url, params=None, **kwargs):
+    def do_work(self, shard_url, work_url, params=None, payload=None, **kwargs):
         """
         Task params are passed as params, additional kwargs passed to taskqueue api.
         params needs to have job_id in it which the parent task should have received.
+        payload is one of PAYLOAD_KEYS, PAYLOAD_COMPACT or PAYLOAD_SHARD; 
+        it defaults to the one in params, passed down from Subscription.do_work.
+        Work handlers get the subscribers back with work_subscribers.
         """
         params = params or {}
+        payload = payload or params.get('payload') or PAYLOAD_KEYS
         # job_id gets passed along
         params.update(shard_url=shard_url, 
                 work_url=work_url, 
                 subscription=self.subscription.urlsafe())
+        task_kwargs, queue_kwargs = _split_options(kwargs)
         # kick off children
+        tasks = []
         for child in self.children:
             params.update(dict(shard=child.urlsafe()))
-            safe_enqueue(shard_url, 
-                    params=params, 
+            tasks.append(taskqueue.Task(url=shard_url, 
+                    params=dict(params), 
                     name='%s-%s' % (params['job_id'], child.id()), 
-                    **kwargs)
+                    **task_kwargs))
 
         # now do work in another task
-        params['subscriber_keys'] = [key.urlsafe() for key in self.subscribers]
-        safe_enqueue(work_url, params=params, **kwargs)
+        throttle = Throttle.from_params(params)
+        separate = throttle is not None or params.get('pull_queue')
+        # named, like its children, so a retry does not deliver twice
+        named = 'job_id' in params
+        if not separate:
+            work_kwargs = dict(task_kwargs)
+            if named:
+                work_kwargs['name'] = '%s-work-%s' % (params['job_id'], self.key.id())
+            tasks.append(_work_task(work_url, self.key, self.subscribers, params, payload, **work_kwargs))
+        safe_enqueue_batch(tasks, **queue_kwargs)
+        if separate:
+            _enqueue_work(work_url, [(self.key, self.subscribers, len(self.subscribers))], 
+                    params, payload, throttle, named=named, **kwargs)
 
     @ndb.transactional
     def add_subscriber(self, ref):
-        self.subscribers = list(set(self.subscribers + [ref]))
+        if ref not in self.subscribers:
+            self.subscribers.append(ref)
         self.put()
 
     @classmethod
@@ -80,6 +125,14 @@ class Shard(ndb.Model):
         if not isinstance(subscription, ndb.Key):
             subscription = subscription.key
 
+        # the open shard pointer usually answers without a query
+        pointer_key = OpenShard.gen_key(subscription)
+        pointer = pointer_key.get()
+        if pointer is not None and pointer.shard is not None:
+            shard = pointer.shard.get()
+            if shard is not None and shard.subscriber_count < shard_size:
+                return shard
+
         def incr_shard_count(_shard):
             # not doing this in a trasaction because the shard count doesn't need 
             # to be accurate; just so it is 0 or some number close to actual child count
@@ -104,26 +157,245 @@ class Shard(ndb.Model):
                 shard = Shard(parent=subscription)
             shard.put()
 
+        OpenShard(key=pointer_key, shard=shard.key).put()
         return shard
 
 
+def _work_task(work_url, shard_key, subscribers, params, payload, **task_kwargs):
+    """
+    The task for work_url carrying a shard's subscribers as payload says, 
+    or, with a pull_queue in params, the pull task for work_pull_queue.
+    """
+    params = dict(params, shard=shard_key.urlsafe())
+    if payload == PAYLOAD_COMPACT:
+        params['subscribers'] = encode_subscribers(subscribers, compress=True)
+    elif payload == PAYLOAD_KEYS:
+        params['subscriber_keys'] = [key.urlsafe() for key in subscribers]
+    if params.get('pull_queue'):
+        return taskqueue.Task(method='PULL', tag=params['job_id'], params=params, **task_kwargs)
+    return taskqueue.Task(url=work_url, params=params, **task_kwargs)
+
+def _enqueue_work(work_url, shards, params, payload, throttle=None, named=False, **kwargs):
+    """
+    Enqueues a work task per shard, given as (key, subscribers, size), 
+    paced and spread across queues by throttle if there is one.
+    named tasks are named after the job and shard.
+    """
+    task_kwargs, queue_kwargs = _split_options(kwargs)
+    if throttle is not None:
+        countdowns = throttle.schedule([size for key, subscribers, size in shards])
+    else:
+        countdowns = [0] * len(shards)
+    by_queue = collections.defaultdict(list)
+    for (key, subscribers, size), countdown in zip(shards, countdowns):
+        options = dict(task_kwargs)
+        if countdown:
+            options['countdown'] = countdown
+        if named:
+            options['name'] = '%s-work-%s' % (params['job_id'], key.id())
+        queue_name = queue_kwargs.get('queue_name', taskqueue.DEFAULT_QUEUE)
+        if params.get('pull_queue'):
+            queue_name = params['pull_queue']
+        elif throttle is not None:
+            queue_name = throttle.queue_for(key, default=queue_name)
+        by_queue[queue_name].append(_work_task(work_url, key, subscribers, params, payload, **options))
+    for queue_name, tasks in by_queue.iteritems():
+        safe_enqueue_batch(tasks, **dict(queue_kwargs, queue_name=queue_name))
+
+def work_pull_queue(queue_name, callback, lease_seconds=60, max_tasks=1000, tag=None, fetch=True):
+    """
+    Worker for fanouts with a pull_queue. Leases up to max_tasks 
+    work items, from many shards and jobs, gets their subscribers 
+    with one get_multi (keys if not fetch) and calls callback 
+    once with all of them. If it returns without raising, the 
+    tasks are deleted together and tracked jobs get their progress 
+    recorded; otherwise the lease runs out and they come back.
+    tag limits it to the job_id given.
+    Returns the number of work items done.
+    """
+    queue = taskqueue.Queue(queue_name)
+    if tag is not None:
+        tasks = queue.lease_tasks_by_tag(lease_seconds, max_tasks, tag=tag)
+    else:
+        tasks = queue.lease_tasks(lease_seconds, max_tasks)
+    if not tasks:
+        return 0
+    items = [task.extract_params() for task in tasks]
+    # shards for work items that carry only the shard, in one get
+    shard_keys = [ndb.Key(urlsafe=params['shard']) for params in items 
+            if not (params.get('subscribers') or 'subscriber_keys' in params)]
+    shards = dict((shard.key.urlsafe(), shard) for shard in ndb.get_multi(shard_keys) if shard is not None)
+    keys, done = [], collections.defaultdict(dict)
+    for params in items:
+        if params.get('subscribers') or 'subscriber_keys' in params:
+            subscribers = work_subscribers(params)
+        else:
+            shard = shards.get(params['shard'])
+            subscribers = list(shard.subscribers) if shard is not None else []
+        keys.extend(subscribers)
+        done[params['job_id']][params['shard']] = len(subscribers)
+    if fetch:
+        callback(filter(None, ndb.get_multi(keys)))
+    else:
+        callback(keys)
+    queue.delete_tasks(tasks)
+    for job_id, shard_subscribers in done.iteritems():
+        FanoutJob.record_multi(job_id, shard_subscribers)
+    return len(tasks)
+
+def encode_subscribers(keys, compress=False):
+    """
+    Compact form of a list of keys for task params.
+    Keys that share app, namespace, parent and kind share 
+    one header and are sent as raw ids.
+    """
+    groups = collections.OrderedDict()
+    for key in keys:
+        header = (key.app(), key.namespace(), key.parent().flat() if key.parent() else (), key.kind())
+        groups.setdefault(header, []).append(key.id())
+    data = json.dumps([list(header) + [ids] for header, ids in groups.iteritems()], 
+            separators=(',', ':'))
+    if compress:
+        return 'z' + base64.b64encode(zlib.compress(data))
+    return 'j' + data
+
+def decode_subscribers(data):
+    """ Keys from encode_subscribers. """
+    if data[0] == 'z':
+        data = zlib.decompress(base64.b64decode(data[1:]))
+    else:
+        data = data[1:]
+    keys = []
+    for app, namespace, parent, kind, ids in json.loads(data):
+        parent = ndb.Key(flat=parent, app=app, namespace=namespace) if parent else None
+        keys.extend(ndb.Key(kind, id, parent=parent, app=app, namespace=namespace) for id in ids)
+    return keys
+
+def work_subscribers(params):
+    """
+    Subscriber keys for a work handler, whichever payload the task carries.
+    params is a dict or the request params (getall is used when present).
+    """
+    if params.get('subscribers'):
+        return decode_subscribers(params['subscribers'])
+    if 'subscriber_keys' in params:
+        if hasattr(params, 'getall'):
+            values = params.getall('subscriber_keys')
+        else:
+            values = params['subscriber_keys']
+        if isinstance(values, basestring):
+            values = [values]
+        return [ndb.Key(urlsafe=value) for value in values]
+    shard = ndb.Key(urlsafe=params['shard']).get()
+    return list(shard.subscribers) if shard is not None else []
+
+def _unique_keys(refs):
+    """ Keys for refs, entities or keys, in order without duplicates. """
+    keys, seen = [], set()
+    for ref in refs:
+        if not isinstance(ref, ndb.Key): ref = ref.key
+        if ref not in seen:
+            seen.add(ref)
+            keys.append(ref)
+    return keys
+
+
+class Membership(ndb.Model):
+    """
+    Reverse index from a subscriber to the shard holding it.
+    Child of the subscription, keyed by the subscriber, so 
+    membership is a get by key in the subscription's entity group.
+    """
+    shard = ndb.KeyProperty(indexed=False)
+
+    @classmethod
+    def gen_key(cls, subscription, ref):
+        return ndb.Key(cls, ref.urlsafe(), parent=subscription)
+
+
+class OpenShard(ndb.Model):
+    """
+    Points at the shard new subscribers go to.
+    Kept apart from the subscription itself so subscribe 
+    never has to put the subscription entity.
+    """
+    shard = ndb.KeyProperty(indexed=False)
+
+    @classmethod
+    def gen_key(cls, subscription):
+        return ndb.Key(cls, 'open', parent=subscription)
+
+
+class PendingSubscriber(ndb.Model):
+    """
+    Write ahead log entry for subscribe_later and unsubscribe_later.
+    Each is its own entity group, so concurrent writers never 
+    contend; merge_pending folds them into the shards in bulk.
+    Keyed by subscription and subscriber, so the latest call wins.
+    """
+    subscription = ndb.KeyProperty()
+    subscriber   = ndb.KeyProperty(indexed=False)
+    subscribe    = ndb.BooleanProperty(default=True, indexed=False)
+    created      = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def gen_key(cls, subscription, ref):
+        return ndb.Key(cls, '%s|%s' % (subscription.urlsafe(), ref.urlsafe()))
+
+
 class Subscription(ndb.Model):
     """
     The subscription model is a little different here from the traditional
     one that might use one subscription instance / entity per subscriber.
     In the fanout model, a Subscription is matched, then all subscribers 
     are 'notified' of this through fanout.
+    Subclasses name the properties events are matched on in 
+    match_fields; an empty one matches any value. See matching.
     """
+    match_fields = ()
+
+    def _post_put_hook(self, future):
+        # a put in a transaction is not there until it commits, if ever; 
+        # call_on_commit waits for that, or runs now outside of one
+        if self.match_fields and future.get_exception() is None:
+            ndb.get_context().call_on_commit(lambda: match.changed(subscription=self))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if cls.match_fields and future.get_exception() is None:
+            ndb.get_context().call_on_commit(lambda: match.changed(kind=key.kind(), key=key))
+
+    @classmethod
+    def matching_keys(cls, event):
+        """
+        Keys of the subscriptions matching event, a dict of match field to 
+        value or list of values, from an index held in this instance. 
+        Puts and deletes in this instance go straight into the index; 
+        other instances rebuild theirs at most once a minute after 
+        a change, so they can lag that long. No datastore query runs 
+        per event.
+        """
+        return list(match.get_index(cls).match(event))
+
+    @classmethod
+    def matching(cls, event):
+        """
+        The subscriptions matching event, see matching_keys; 
+        then do_work on each.
+        """
+        return filter(None, ndb.get_multi(cls.matching_keys(event)))
+
     @ndb.transactional
     def subscribe(self, ref, shard_size=_SHARD_SIZE, shard_child_limit=_SHARD_CHILDREN_LIMIT):
         """
         Add a subscriber.
         """
         if not isinstance(ref, ndb.Key): ref = ref.key
-        existing = self.shards(ref=ref, limit=1)
-        if existing is None:
+        member_key = Membership.gen_key(self.key, ref)
+        if member_key.get() is None:
             shard = Shard.find_shard(self, shard_size=shard_size, shard_child_limit=shard_child_limit)
             shard.add_subscriber(ref)
+            Membership(key=member_key, shard=shard.key).put()
 
     @ndb.transactional
     def unsubscribe(self, ref):
@@ -131,11 +403,325 @@ class Subscription(ndb.Model):
         Remove a subscriber.
         """
         if not isinstance(ref, ndb.Key): ref = ref.key
-        existing = self.shards(ref=ref)
-        if len(existing) > 0:
-            for shard in existing:
+        member = Membership.gen_key(self.key, ref).get()
+        if member is not None:
+            shard = member.shard.get()
+            if shard is not None:
                 shard.subscribers = [sub for sub in shard.subscribers if sub != ref]
                 shard.put()
+            member.key.delete()
+
+    def subscribe_many(self, refs, shard_size=_SHARD_SIZE, shard_child_limit=_SHARD_CHILDREN_LIMIT, 
+            batch_size=500):
+        """
+        Add many subscribers. Each batch of refs is one transaction.
+        Returns the number that were not already subscribed.
+        """
+        refs = _unique_keys(refs)
+        added = 0
+        for i in xrange(0, len(refs), batch_size):
+            added += self._subscribe_batch(refs[i:i + batch_size], shard_size, shard_child_limit)
+        return added
+
+    @ndb.transactional
+    def _subscribe_batch(self, refs, shard_size, shard_child_limit):
+        """
+        Checks membership with one get, fills the shards that 
+        have room, then adds new shards breadth first the same 
+        way find_shard would, all written with put_multi.
+        """
+        members = ndb.get_multi([Membership.gen_key(self.key, ref) for ref in refs])
+        pending = [ref for ref, member in zip(refs, members) if member is None]
+        if not pending:
+            return 0
+        placed = [] # (ref, shard)
+
+        def fill(shard):
+            room = shard_size - len(shard.subscribers)
+            take = pending[:room]
+            del pending[:room]
+            shard.subscribers.extend(take)
+            placed.extend((ref, shard) for ref in take)
+
+        base_query = Shard.query(ancestor = self.key)
+        changed = [] # existing shards to put
+        for shard in base_query.filter(Shard.subscriber_count < shard_size):
+            if not pending:
+                break
+            fill(shard)
+            changed.append(shard)
+
+        new_shards = []
+        if pending:
+            new_shards, parents, gained = self._new_shards(
+                    -(-len(pending) // shard_size), shard_child_limit)
+            for shard in new_shards:
+                fill(shard)
+            # not accurate under concurrency, no more than find_shard's
+            loaded = dict((shard.key, shard) for shard in changed)
+            missing = [key for key in gained if key not in loaded]
+            for key, shard in zip(missing, ndb.get_multi(missing)):
+                loaded[key] = shard
+                changed.append(shard)
+            for key, count in gained.iteritems():
+                loaded[key].shard_child_count += count
+            # new shards go in by level, each level once its parents have keys
+            remaining = range(len(new_shards))
+            while remaining:
+                level = [i for i in remaining if isinstance(parents[i], ndb.Key) 
+                        or new_shards[parents[i]].key is not None]
+                for i in level:
+                    parent = parents[i]
+                    parent_key = parent if isinstance(parent, ndb.Key) else new_shards[parent].key
+                    new_shards[i].key = ndb.Key(Shard, None, parent=parent_key)
+                ndb.put_multi([new_shards[i] for i in level])
+                remaining = [i for i in remaining if i not in level]
+
+        last = placed[-1][1]
+        ndb.put_multi(changed + 
+                [Membership(key=Membership.gen_key(self.key, ref), shard=shard.key) 
+                    for ref, shard in placed] + 
+                [OpenShard(key=OpenShard.gen_key(self.key), shard=last.key)])
+        return len(placed)
+
+    def _new_shards(self, n, shard_child_limit):
+        """
+        Lays out n new shards. Parents are chosen in the order 
+        find_shard uses: most children first, then shallowest.
+        Returns the new shards, without keys, their parents, 
+        a key or the index of another new shard, and a dict 
+        of existing parent key to the children it gained.
+        """
+        candidates = Shard.query(ancestor = self.key)
+        candidates = candidates.filter(Shard.shard_child_count < shard_child_limit)
+        candidates = candidates.order(-Shard.shard_child_count).order(Shard.depth)
+        # n new shards use at most the first n, in the heap's order
+        candidates = candidates.fetch(n, projection=[Shard.shard_child_count, Shard.depth])
+
+        # entries are (-child count, depth, sequence, node)
+        heap, counts, sequence = [], collections.Counter(), itertools.count()
+        def push(node, count, depth):
+            heapq.heappush(heap, (-count, depth, next(sequence), node))
+        for candidate in candidates:
+            push(candidate.key, candidate.shard_child_count, candidate.depth)
+
+        new_shards, parents = [], []
+        for i in xrange(0, n):
+            if heap:
+                count, depth, seq, parent = heapq.heappop(heap)
+                counts[parent] += 1
+                if -count + 1 < shard_child_limit:
+                    push(parent, -count + 1, depth)
+                push(i, 0, depth + 1)
+            else:
+                parent = self.key
+                push(i, 0, 0)
+            new_shards.append(Shard(shard_child_count=0))
+            parents.append(parent)
+
+        for i, shard in enumerate(new_shards):
+            shard.shard_child_count = counts[i]
+        existing = dict((node, count) for node, count in counts.iteritems() 
+                if isinstance(node, ndb.Key))
+        return new_shards, parents, existing
+
+    def unsubscribe_many(self, refs, batch_size=500):
+        """
+        Remove many subscribers. Each batch of refs is one transaction.
+        Returns the number that were subscribed.
+        """
+        refs = _unique_keys(refs)
+        removed = 0
+        for i in xrange(0, len(refs), batch_size):
+            removed += self._unsubscribe_batch(refs[i:i + batch_size])
+        return removed
+
+    @ndb.transactional
+    def _unsubscribe_batch(self, refs):
+        members = ndb.get_multi([Membership.gen_key(self.key, ref) for ref in refs])
+        leaving = collections.defaultdict(set)
+        for ref, member in zip(refs, members):
+            if member is not None:
+                leaving[member.shard].add(ref)
+        shards = filter(None, ndb.get_multi(leaving.keys()))
+        for shard in shards:
+            shard.subscribers = [sub for sub in shard.subscribers if sub not in leaving[shard.key]]
+        ndb.put_multi(shards)
+        ndb.delete_multi([member.key for member in members if member is not None])
+        return sum(len(gone) for gone in leaving.itervalues())
+
+    def subscribe_later(self, ref, merge_url, **kwargs):
+        """
+        Add a subscriber without touching the subscription's entity 
+        group, for when many subscribe at once. The subscriber is 
+        logged and a task to merge_url is queued, at most one per 
+        _MERGE_INTERVAL; its handler calls merge_pending. 
+        Until then, subscribed does not see it.
+        Additional kwargs passed to taskqueue api.
+        """
+        self._log_pending(ref, True, merge_url, **kwargs)
+
+    def unsubscribe_later(self, ref, merge_url, **kwargs):
+        """
+        Remove a subscriber the same way subscribe_later adds one.
+        """
+        self._log_pending(ref, False, merge_url, **kwargs)
+
+    def _log_pending(self, ref, subscribe, merge_url, **kwargs):
+        if not isinstance(ref, ndb.Key): ref = ref.key
+        PendingSubscriber(key=PendingSubscriber.gen_key(self.key, ref), 
+                subscription=self.key, subscriber=ref, subscribe=subscribe).put()
+        self._schedule_merge(merge_url, **kwargs)
+
+    def _schedule_merge(self, merge_url, **kwargs):
+        # one task per interval; the name makes the rest no-ops
+        now = time.time()
+        slot = int(now / _MERGE_INTERVAL)
+        name = 'merge-%s-%d' % (hashlib.md5(self.key.urlsafe()).hexdigest(), slot)
+        # an interval past the end of the slot, so every entry logged 
+        # in it is that old, and visible to the query, when it runs
+        safe_enqueue(merge_url, 
+                params=dict(subscription=self.key.urlsafe()), 
+                name=name, 
+                countdown=(slot + 2) * _MERGE_INTERVAL - now, 
+                **kwargs)
+
+    def merge_pending(self, merge_url=None, shard_size=_SHARD_SIZE, 
+            shard_child_limit=_SHARD_CHILDREN_LIMIT, batch_size=500, **kwargs):
+        """
+        Folds logged subscribes and unsubscribes into the shards with 
+        subscribe_many and unsubscribe_many. The log is read with 
+        an eventually consistent query, so if anything was merged 
+        and merge_url is given, another merge is queued to pick 
+        up entries that were not visible yet.
+        Returns the number of log entries merged.
+        """
+        query = PendingSubscriber.query(PendingSubscriber.subscription == self.key)
+        merged = 0
+        for pending in QueryExec(query, batch_size=batch_size).get_by_page():
+            subscribes = [entry.subscriber for entry in pending if entry.subscribe]
+            unsubscribes = [entry.subscriber for entry in pending if not entry.subscribe]
+            self.subscribe_many(subscribes, 
+                    shard_size=shard_size, shard_child_limit=shard_child_limit, batch_size=batch_size)
+            self.unsubscribe_many(unsubscribes, batch_size=batch_size)
+            # only delete entries nobody has overwritten in the meantime
+            current = ndb.get_multi([entry.key for entry in pending])
+            ndb.delete_multi([entry.key for entry, now in zip(pending, current) 
+                if now is not None and now.created == entry.created])
+            merged += len(pending)
+        if merged and merge_url is not None:
+            self._schedule_merge(merge_url, **kwargs)
+        return merged
+
+    def compact(self, url=None, shard_size=_SHARD_SIZE, batch_size=200, steps=10, **kwargs):
+        """
+        Repacks subscribers into full shards and prunes the leaf 
+        shards left empty, so a fanout costs fewer tasks after churn.
+        Subscribers move from the deepest, emptiest leaves into the 
+        shallowest, fullest shards with room, so the tree also gets 
+        shallower. Each step moves up to batch_size subscribers in 
+        one transaction on the subscription's entity group, which 
+        is what keeps it safe alongside subscribe and unsubscribe. 
+        Best run between fanouts; a work task that reads its shard 
+        (PAYLOAD_SHARD) can miss subscribers moved out from under it.
+        After steps steps, if there is more to do and url is given, 
+        a task to url carries on; its handler calls compact again.
+        Additional kwargs passed to taskqueue api.
+        Returns whether there is more to do.
+        """
+        for i in xrange(0, steps):
+            if not self._compact_step(shard_size, batch_size):
+                return False
+        if url is not None:
+            safe_enqueue(url, 
+                    params=dict(subscription=self.key.urlsafe(), shard_size=shard_size), 
+                    **kwargs)
+        return True
+
+    @ndb.transactional
+    def _compact_step(self, shard_size, batch_size, candidates=50):
+        """
+        Moves up to batch_size subscribers and deletes the leaves 
+        emptied. Reads no more than candidates receivers, the fullest 
+        shards with room, and candidates donors, the emptiest, so 
+        a step costs the same however big the tree is.
+        Returns whether anything changed.
+        """
+        open_query = Shard.query(ancestor = self.key).filter(Shard.subscriber_count < shard_size)
+        receiver_future = open_query.order(-Shard.subscriber_count).order(Shard.depth).fetch_async(candidates)
+        # interior shards keep their children reachable; only leaves give
+        donor_query = open_query.filter(Shard.shard_child_count == 0)
+        donor_future = donor_query.order(Shard.subscriber_count).order(-Shard.depth).fetch_async(candidates)
+        # one entity per shard, whichever query found it
+        loaded = {}
+        receivers = [loaded.setdefault(shard.key, shard) for shard in receiver_future.get_result()]
+        donors = [loaded.setdefault(shard.key, shard) for shard in donor_future.get_result()]
+        # shard_child_count can drift, so each donor is checked for children
+        child_futures = [Shard.query(ancestor = donor.key).filter(Shard.depth == donor.depth + 1)
+                .get_async(keys_only=True) for donor in donors]
+        donors = [donor for donor, future in zip(donors, child_futures) if future.get_result() is None]
+
+        # shallowest, fullest first; a donor must rank below its receiver
+        rank = dict((shard.key, (shard.depth, -shard.subscriber_count, shard.key)) for shard in loaded.values())
+        receivers.sort(key=lambda shard: rank[shard.key])
+        donors.sort(key=lambda shard: rank[shard.key], reverse=True)
+        moved, changed, members = 0, {}, []
+        # empty leaves go whether or not there is anywhere to fill
+        emptied = [donor for donor in donors if not donor.subscribers]
+        donors = [donor for donor in donors if donor.subscribers]
+        gone = set(shard.key for shard in emptied)
+        receivers = [receiver for receiver in receivers if receiver.key not in gone]
+        front, back = 0, 0
+        while front < len(receivers) and back < len(donors) and moved < batch_size:
+            receiver, donor = receivers[front], donors[back]
+            if rank[receiver.key] >= rank[donor.key]:
+                break
+            room = shard_size - len(receiver.subscribers)
+            take = donor.subscribers[:min(room, batch_size - moved)]
+            if take:
+                del donor.subscribers[:len(take)]
+                receiver.subscribers.extend(take)
+                members.extend(Membership(key=Membership.gen_key(self.key, ref), shard=receiver.key) 
+                        for ref in take)
+                changed[receiver.key] = receiver
+                changed[donor.key] = donor
+                moved += len(take)
+            if not donor.subscribers:
+                emptied.append(donor)
+                changed.pop(donor.key, None)
+                back += 1
+            if len(receiver.subscribers) >= shard_size:
+                front += 1
+        if not (moved or emptied):
+            return False
+
+        # parents lose the children pruned
+        lost = collections.Counter(shard.key.parent() for shard in emptied 
+                if shard.key.parent().kind() == Shard._get_kind())
+        parents = [changed.get(key) or shard for key, shard in 
+                zip(lost.keys(), ndb.get_multi(lost.keys())) if shard is not None]
+        for parent in parents:
+            parent.shard_child_count = max(0, parent.shard_child_count - lost[parent.key])
+            changed[parent.key] = parent
+        ndb.put_multi(changed.values() + members)
+        ndb.delete_multi([shard.key for shard in emptied])
+        return True
+
+    def subscribed(self, ref):
+        """
+        Whether ref is a subscriber.
+        """
+        if not isinstance(ref, ndb.Key): ref = ref.key
+        return Membership.gen_key(self.key, ref).get() is not None
+
+    def reindex(self):
+        """
+        Builds the subscriber index from the shards. Needed once for 
+        subscriptions with subscribers from before the index existed.
+        """
+        for shards in QueryExec(Shard.query(ancestor = self.key)).get_by_page():
+            ndb.put_multi([Membership(key=Membership.gen_key(self.key, ref), shard=shard.key) 
+                for shard in shards for ref in shard.subscribers])
 
     @ndb.transactional
     def shards(self, ref=None, limit=500):
@@ -148,21 +734,133 @@ class Subscription(ndb.Model):
             query = query.filter(Shard.subscribers == ref)
         return query.get() if limit == 1 else query.fetch(limit)
 
-    def do_work(self, shard_url, params=None, job_id=None, **kwargs):
+    def do_work(self, shard_url, params=None, job_id=None, track=False, completion_url=None, 
+            payload=None, rate=None, queues=None, max_backlog=None, pull_queue=None, **kwargs):
         """
         Task params are passed as params, additional kwargs passed to taskqueue api.
+        payload picks how the work tasks carry subscribers, see Shard.do_work.
+        rate, queues and max_backlog pace the work tasks, see Throttle.
+        With pull_queue, work goes there as pull tasks for work_pull_queue.
+        With track or a completion_url, a FanoutJob counts the work; 
+        work handlers then call FanoutJob.record(job_id, shard, len(subscriber_keys)).
+        Returns the job_id.
         """
         # job_id prevents fork bomb on fanout; passed to shards
-        job_id = job_id or base64.b32encode(uuid.uuid4().bytes).strip('=').lower()
+        job_id = self._start_job(job_id, track, completion_url)
         # first tier of shards
         shards = Shard.query(ancestor = self.key).filter(Shard.depth == 0).fetch(keys_only=True)
         params = params or {}
         params.update(dict(shard_url=shard_url, 
             subscription=self.key.urlsafe()),
             job_id=job_id)
+        if payload:
+            params['payload'] = payload
+        if pull_queue:
+            params['pull_queue'] = pull_queue
+        params.update(Throttle(job_id, rate=rate, queues=queues, max_backlog=max_backlog).to_params())
+        task_kwargs, queue_kwargs = _split_options(kwargs)
+        tasks = []
         for shard in shards:
             params.update(dict(shard=shard.urlsafe()))
-            safe_enqueue(shard_url, 
-                    params=params, 
+            tasks.append(taskqueue.Task(url=shard_url, 
+                    params=dict(params), 
                     name='%s-%s' % (job_id, shard.id()), 
-                    **kwargs)
+                    **task_kwargs))
+        safe_enqueue_batch(tasks, **queue_kwargs)
+        return job_id
+
+    def _start_job(self, job_id, track, completion_url):
+        job_id = job_id or base64.b32encode(uuid.uuid4().bytes).strip('=').lower()
+        if track or completion_url:
+            # one work task per shard that exists now
+            sizes = [shard.subscriber_count for shard in 
+                    Shard.query(ancestor = self.key).iter(projection=[Shard.subscriber_count])]
+            FanoutJob.start(job_id, self.key, len(sizes), sum(sizes), completion_url=completion_url)
+        return job_id
+
+    def dispatch(self, work_url, dispatch_url=None, dispatchers=1, params=None, job_id=None, 
+            track=False, completion_url=None, payload=PAYLOAD_SHARD, batch_size=500, 
+            rate=None, queues=None, max_backlog=None, pull_queue=None, **kwargs):
+        """
+        Flat alternative to do_work. Rather than one task hop per 
+        tier of the shard tree, the shards are read with paged 
+        queries and a work task is enqueued for each directly.
+        With dispatch_url and dispatchers > 1 the shards are split 
+        into key ranges and a task per range goes to dispatch_url, 
+        whose handler calls dispatch_range with the task params.
+        With PAYLOAD_SHARD, the default, only keys are read.
+        rate, queues and max_backlog pace the work tasks, see Throttle.
+        With pull_queue, work goes there as pull tasks for work_pull_queue.
+        Task params are passed as params, additional kwargs passed to taskqueue api.
+        Returns the job_id.
+        """
+        job_id = self._start_job(job_id, track, completion_url)
+        params = dict(params or {}, 
+                subscription=self.key.urlsafe(), 
+                job_id=job_id, 
+                payload=payload, 
+                work_url=work_url, 
+                batch_size=batch_size)
+        if pull_queue:
+            params['pull_queue'] = pull_queue
+        params.update(Throttle(job_id, rate=rate, queues=queues, max_backlog=max_backlog).to_params())
+        if dispatch_url is None or dispatchers < 2:
+            self.dispatch_range(params, **kwargs)
+            return job_id
+
+        # __scatter__ samples span every subscription's shards, so the 
+        # bounds come from a keys only pass over this one's instead
+        query = QueryExec(Shard.query(ancestor = self.key), batch_size=1000)
+        keys = list(query.iter_entities(keys_only=True))
+        step = len(keys) / float(dispatchers)
+        points = sorted(set(keys[int(i * step)] for i in xrange(1, dispatchers) if int(i * step) > 0))
+        bounds = [None] + points + [None]
+        task_kwargs, queue_kwargs = _split_options(kwargs)
+        tasks = []
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            range_params = dict(params)
+            if start is not None:
+                range_params['start'] = start.urlsafe()
+            if end is not None:
+                range_params['end'] = end.urlsafe()
+            tasks.append(taskqueue.Task(url=dispatch_url, 
+                    params=range_params, 
+                    name='%s-dispatch-%i' % (job_id, i), 
+                    **task_kwargs))
+        safe_enqueue_batch(tasks, **queue_kwargs)
+        return job_id
+
+    def dispatch_range(self, params, **kwargs):
+        """
+        Enqueues a work task for every shard in the key range 
+        given by params from dispatch, a page at a time.
+        Additional kwargs passed to taskqueue api.
+        """
+        params = dict(params)
+        work_url = params.pop('work_url')
+        batch_size = int(params.pop('batch_size', 500))
+        start, end = [ndb.Key(urlsafe=params.pop(bound)) if params.get(bound) else None 
+                for bound in ('start', 'end')]
+        payload = params.get('payload') or PAYLOAD_SHARD
+        throttle = Throttle.from_params(params)
+        query = QueryExec(Shard.query(ancestor = self.key), batch_size=batch_size, prefetch=1)
+        query = query.key_range(start, end)
+        fetch_options = {}
+        if payload == PAYLOAD_SHARD:
+            # pacing needs the sizes, which a projection has too
+            if throttle is not None and throttle.rate:
+                fetch_options = dict(projection=[Shard.subscriber_count])
+            else:
+                fetch_options = dict(keys_only=True)
+        count = 0
+        for page in query.get_by_page(**fetch_options):
+            if payload != PAYLOAD_SHARD:
+                shards = [(shard.key, shard.subscribers, shard.subscriber_count) for shard in page]
+            elif fetch_options.get('keys_only'):
+                shards = [(key, [], 0) for key in page]
+            else:
+                shards = [(shard.key, [], shard.subscriber_count) for shard in page]
+            # named so a retried dispatcher does not deliver twice
+            _enqueue_work(work_url, shards, params, payload, throttle, named=True, **kwargs)
+            count += len(shards)
+        return count
@@ -0,0 +1,98 @@
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+_SLOT_KEY = '_fanout_slot-{}'            # job_id; end of the time reserved so far, in ms
+_FAILURE_KEY = '_fanout_failures-{}-{}'  # job_id, minute
+_SLOT_LIFE = 60*60*24
+_FAILURE_SCALE = 10.0  # failures in a minute that halve the rate
+_MIN_FACTOR = 0.05     # backing off never goes below this share of the rate
+
+class Throttle(object):
+    """
+    Paces the work tasks of one fanout job to rate deliveries 
+    (subscribers) a second, by giving each task a countdown, and 
+    spreads them across queues by a hash of the shard key.
+    The time reserved so far is one memcache counter per job, 
+    shared by every shard task of the job.
+    The rate backs off while the queues hold more than max_backlog 
+    tasks, and for each failure work handlers report with failed.
+    Carried from task to task in the params.
+    """
+    def __init__(self, job_id, rate=None, queues=None, max_backlog=None):
+        self.job_id = job_id
+        self.rate = float(rate) if rate else None
+        self.queues = list(queues or [])
+        self.max_backlog = int(max_backlog) if max_backlog else None
+
+    @classmethod
+    def from_params(cls, params):
+        """ The throttle in task params, or None if there is none. """
+        if not (params.get('rate') or params.get('queues')):
+            return None
+        queues = params.get('queues')
+        if isinstance(queues, basestring):
+            queues = queues.split(',')
+        return cls(params['job_id'], 
+                rate=params.get('rate'), 
+                queues=queues, 
+                max_backlog=params.get('max_backlog'))
+
+    def to_params(self):
+        params = {}
+        if self.rate:
+            params['rate'] = self.rate
+        if self.queues:
+            params['queues'] = ','.join(self.queues)
+        if self.max_backlog:
+            params['max_backlog'] = self.max_backlog
+        return params
+
+    def queue_for(self, shard_key, default=None):
+        if not self.queues:
+            return default
+        return self.queues[zlib.crc32(shard_key.urlsafe()) % len(self.queues)]
+
+    @staticmethod
+    def failed(job_id, n=1):
+        """ Work handlers report failed deliveries, which slows the job down. """
+        key = _FAILURE_KEY.format(job_id, int(time.time() / 60))
+        memcache.incr(key, n, initial_value=0)
+
+    def current_rate(self):
+        rate = self.rate
+        failures = memcache.get(_FAILURE_KEY.format(self.job_id, int(time.time() / 60))) or 0
+        factor = 1.0 / (1.0 + failures / _FAILURE_SCALE)
+        if self.max_backlog:
+            queues = self.queues or ['default']
+            backlog = sum(stats.tasks for stats in taskqueue.QueueStatistics.fetch(queues))
+            if backlog > self.max_backlog:
+                factor *= self.max_backlog / float(backlog)
+        return rate * max(factor, _MIN_FACTOR)
+
+    def schedule(self, sizes):
+        """
+        Countdowns, in seconds, for tasks delivering sizes 
+        subscribers each, reserved in one memcache call.
+        """
+        if not self.rate:
+            return [0] * len(sizes)
+        rate = self.current_rate()
+        now = int(time.time() * 1000)
+        duration = int(sum(sizes) / rate * 1000)
+        key = _SLOT_KEY.format(self.job_id)
+        end = memcache.incr(key, duration, initial_value=now)
+        if end is None:
+            return [0] * len(sizes) # memcache down; no pacing
+        start = end - duration
+        if start < now - 1000:
+            # idle for a while; do not let the lag turn into a burst
+            end = memcache.incr(key, now - start) or end
+            start = end - duration
+        countdowns, offset = [], 0.0
+        for size in sizes:
+            countdowns.append(max(0, (start + offset - now) / 1000.0))
+            offset += size / rate * 1000
+        return countdowns
@@ -1,7 +1,21 @@
+import contextlib
+import datetime
+import time
+import uuid
+
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from gaeutils import models
 
+LEASE_KEY = '_lock_lease-{}'
+_RELEASED = '-' # lease value once its owner let go
+_RELEASED_LIFE = 60*60
+MAX_XG_GROUPS = 25 # entity groups one cross group transaction may touch
+
+class LockTaken(Exception):
+    """ Raised by Lock.lease when another owner holds the lock. """
+
 class Semaphore(models.NoCache):
     """
     A small datastore entity as a semaphore.
@@ -10,15 +24,23 @@ class Semaphore(models.NoCache):
     name = ndb.StringProperty(required=True)
 
     @classmethod
-    @ndb.transactional
+    @ndb.tasklet
+    def get_async(cls, name):
+        @ndb.tasklet
+        def txn():
+            key = ndb.Key(cls, name)
+            # read by key, eventual consistency does not come into play
+            semaphore = yield key.get_async()
+            if not semaphore:
+                semaphore = cls(key=key, name=name)
+                yield semaphore.put_async()
+            raise ndb.Return(semaphore)
+        semaphore = yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.ALLOWED)
+        raise ndb.Return(semaphore)
+
+    @classmethod
     def get(cls, name):
-        key = ndb.Key(cls, name)
-        # read by key, eventual consistency does not come into play
-        semaphore = key.get()
-        if not semaphore:
-            semaphore = cls(key=key, name=name)
-            semaphore.put()
-        return semaphore
+        return cls.get_async(name).get_result()
 
 class Lock(Semaphore):
     """
@@ -38,18 +60,188 @@ class Lock(Semaphore):
        If it is different, something changed when 
        you didn't expect it; rollback, schedule later, drop it, etc.
     see tests for example usage
+
+    For mutual exclusion, acquire a lease instead:
+    1. token = Lock.acquire(name, ttl); None if someone else has it
+    2. Do some work, within ttl seconds
+    3. Lock.release(name, token)
+    or with Lock.lease(name, ttl): ...
     """
     ver  = ndb.IntegerProperty(default=0)
+    # lease holder, set only by durable leases
+    owner   = ndb.StringProperty(indexed=False)
+    expires = ndb.DateTimeProperty(indexed=False)
 
     @staticmethod
-    @ndb.transactional
-    def incr(name, amount=1):
+    @ndb.tasklet
+    def incr_async(name, amount=1):
         # will propogate a transaction
+        @ndb.tasklet
+        def txn():
+            # pays the price of double put very first time created
+            # but these are typically used frequently and that is better
+            # than duplicated code, or a 'create' switch
+            lock = yield Lock.get_async(name)
+            lock.ver += amount
+            yield lock.put_async()
+            raise ndb.Return(lock)
+        lock = yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.ALLOWED)
+        raise ndb.Return(lock)
+
+    @staticmethod
+    def incr(name, amount=1):
+        return Lock.incr_async(name, amount=amount).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_versions_async(names):
+        """
+        Versions of many locks, as a dict of name to ver, with one get_multi.
+        Locks that do not exist yet are at 0 and are not created.
+        """
+        names = list(names)
+        locks = yield ndb.get_multi_async([ndb.Key(Lock, name) for name in names])
+        raise ndb.Return(dict((name, lock.ver if lock else 0) for name, lock in zip(names, locks)))
+
+    @staticmethod
+    def get_versions(names):
+        return Lock.get_versions_async(names).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def verify_async(versions):
+        """
+        Whether every lock is still at the version in versions, 
+        a dict from get_versions. The pattern above for many locks: 
+        get_versions before the work, verify after; inside an xg 
+        transaction the check is part of it.
+        """
+        current = yield Lock.get_versions_async(versions.keys())
+        raise ndb.Return(current == versions)
+
+    @staticmethod
+    def verify(versions):
+        return Lock.verify_async(versions).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def incr_many_async(names, amount=1):
+        """
+        Increments many locks in one cross group transaction, or the 
+        caller's. names may be a dict of name to amount.
+        Returns a dict of name to Lock.
+        """
+        if isinstance(names, dict):
+            amounts = dict(names)
+        else:
+            amounts = dict((name, amount) for name in names)
+        if len(amounts) > MAX_XG_GROUPS:
+            raise ValueError('at most %i locks in one transaction' % MAX_XG_GROUPS)
+
+        @ndb.tasklet
+        def txn():
+            keys = [ndb.Key(Lock, name) for name in amounts]
+            locks = yield ndb.get_multi_async(keys)
+            locks = [lock or Lock(key=key, name=key.id()) for key, lock in zip(keys, locks)]
+            for lock in locks:
+                lock.ver += amounts[lock.name]
+            yield ndb.put_multi_async(locks)
+            raise ndb.Return(dict((lock.name, lock) for lock in locks))
+        locks = yield ndb.transaction_async(txn, xg=len(amounts) > 1, 
+                propagation=ndb.TransactionOptions.ALLOWED)
+        raise ndb.Return(locks)
+
+    @staticmethod
+    def incr_many(names, amount=1):
+        return Lock.incr_many_async(names, amount=amount).get_result()
+
+    @staticmethod
+    def acquire(name, ttl=30, durable=False):
+        """
+        Takes the lease on name for ttl seconds with one memcache add, 
+        or a gets and cas over a released lease.
+        Returns the owner token to release it with, or None if it is held.
+        memcache alone can lose a lease to eviction; with durable the 
+        lease is also taken on the Lock entity in a transaction, which 
+        has the final say, and decides when memcache cannot.
+        Without durable, a lease memcache cannot vouch for is not taken.
+        """
+        token = uuid.uuid4().hex
+        key = LEASE_KEY.format(name)
+        client = memcache.Client()
+        if not client.add(key, token, time=ttl):
+            current = client.gets(key)
+            if current == _RELEASED:
+                if not client.cas(key, token, time=ttl):
+                    return None # someone else got there first
+            elif current is not None:
+                return None
+            elif durable:
+                # memcache is not answering; go by the datastore
+                return token if Lock._take(name, token, ttl) else None
+            elif not client.add(key, token, time=ttl):
+                # ran out just now, or memcache is not answering
+                return None
+        if durable and not Lock._take(name, token, ttl):
+            # held by a lease memcache forgot about
+            Lock._release_memcache(client, key, token)
+            return None
+        return token
+
+    @staticmethod
+    def release(name, token, durable=False):
+        """
+        Gives up the lease if token still owns it; a lease that ran 
+        out and was taken by someone else is left alone.
+        """
+        Lock._release_memcache(memcache.Client(), LEASE_KEY.format(name), token)
+        if durable:
+            Lock._give_back(name, token)
 
-        # pays the price of double put very first time created
-        # but these are typically used frequently and that is better
-        # than duplicated code, or a 'create' switch
-        lock = Lock.get(name) 
-        lock.ver += amount
+    @staticmethod
+    def _release_memcache(client, key, token):
+        # cas swaps in the marker only if nobody took the lease since gets
+        if client.gets(key) == token:
+            client.cas(key, _RELEASED, time=_RELEASED_LIFE)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lease(name, ttl=30, durable=False, wait=0):
+        """
+        with Lock.lease(name): ...
+        Waits up to wait seconds for the lease, then raises LockTaken.
+        """
+        deadline = time.time() + wait
+        delay = 0.05
+        token = Lock.acquire(name, ttl=ttl, durable=durable)
+        while token is None and time.time() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            delay *= 2
+            token = Lock.acquire(name, ttl=ttl, durable=durable)
+        if token is None:
+            raise LockTaken(name)
+        try:
+            yield token
+        finally:
+            Lock.release(name, token, durable=durable)
+
+    @staticmethod
+    @ndb.transactional
+    def _take(name, token, ttl):
+        lock = Lock.get(name)
+        now = datetime.datetime.utcnow()
+        if lock.owner and lock.expires and lock.expires > now:
+            return False
+        lock.owner = token
+        lock.expires = now + datetime.timedelta(seconds=ttl)
         lock.put()
-        return lock
+        return True
+
+    @staticmethod
+    @ndb.transactional
+    def _give_back(name, token):
+        lock = Lock.get(name)
+        if lock.owner == token:
+            lock.owner = None
+            lock.expires = None
+            lock.put()
@@ -8,6 +8,16 @@ class NoCache(ndb.Model):
     _use_cache    = False
     _use_memcache = False
 
+class Checkpoint(NoCache):
+    """
+    How far a long running query has got.
+    Keyed by name of the job.
+    """
+    cursor  = ndb.StringProperty(indexed=False) # urlsafe
+    count   = ndb.IntegerProperty(default=0, indexed=False)
+    done    = ndb.BooleanProperty(default=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
 class FauxFuture(object):
     """
     Stand in when not really querying
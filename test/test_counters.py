@@ -1,4 +1,8 @@
+import time
+
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 
 import tests
 
@@ -38,6 +42,215 @@ class TestCounters(tests.TestBase):
             counters.increment(name) 
         self.assertEqual(counters.get_count(name), 100)
 
+class TestMultiCounters(tests.TestBase):
+    def test_get_counts(self):
+        counters.increment('a')
+        counters.increment('b', delta=3)
+        self.assertEqual(dict(a=1, b=3, c=0), counters.get_counts(['a', 'b', 'c']))
+        # cached
+        self.assertEqual(dict(a=1, b=3, c=0), counters.get_counts(['a', 'b', 'c']))
+        self.assertEqual(dict(a=1, b=3), counters.get_counts(['a', 'b'], use_cache=False))
+
+    def test_increment_multi(self):
+        counters.increment_multi(dict(a=1, b=2, c=3))
+        counters.increment_multi(dict(a=1, b=-1))
+        self.assertEqual(dict(a=2, b=1, c=3), counters.get_counts(['a', 'b', 'c']))
+
+    def test_increment_multi_buffered(self):
+        counters.increment_multi(dict(a=1, b=2, c=-1), buffered=True)
+        self.assertEqual(dict(a=1, b=2, c=-1), counters.get_counts(['a', 'b', 'c']))
+        self.assertEqual(2, counters.flush('b'))
+        self.assertEqual(dict(a=1, b=2, c=-1), counters.get_counts(['a', 'b', 'c']))
+
+class TestAsyncCounters(tests.TestBase):
+    @ndb.toplevel
+    def test_async(self):
+        # all in flight together
+        with gaeutils.FutStack() as futures:
+            futures.push(counters.increment_async('a'))
+            futures.push(counters.increment_async('b', delta=2))
+            futures.push(Counter.increment_async('c', delta=3))
+            while len(futures):
+                futures.pop()
+        a, b = counters.get_count_async('a'), counters.get_count_async('b')
+        self.assertEqual((1, 2), (a.get_result(), b.get_result()))
+        self.assertEqual(3, Counter.get_or_create_async('c').get_result().count)
+
+    def test_get_or_create_async(self):
+        counter = Counter.get_or_create_async('foo', domain='zzz').get_result()
+        self.assertEqual(0, counter.count)
+        self.assertEqual('zzz', counter.domain)
+        self.assertEqual(counter.key, Counter.get('foo', domain='zzz').key)
+
+class TestContention(tests.TestBase):
+    def test_scales_on_contention(self):
+        name = 'testcounter'
+        counters.increment(name)
+        for i in range(0, counters.CONTENTION_THRESHOLD - 1):
+            counters._record_contention(name, counters.DEFAULT_NUM_SHARDS)
+        self.assertEqual(counters.DEFAULT_NUM_SHARDS, 
+                counters.ShardConfig.get_by_id(name).num_shards)
+        counters._record_contention(name, counters.DEFAULT_NUM_SHARDS)
+        self.assertEqual(counters.DEFAULT_NUM_SHARDS * 2, 
+                counters.ShardConfig.get_by_id(name).num_shards)
+        # count survives the change
+        counters.increment(name)
+        self.assertEqual(2, counters.get_count(name, use_cache=False))
+
+    def test_capped(self):
+        name = 'testcounter'
+        for i in range(0, counters.CONTENTION_THRESHOLD):
+            counters._record_contention(name, counters.MAX_NUM_SHARDS)
+        self.assertEqual(counters.MAX_NUM_SHARDS, 
+                counters.ShardConfig.get_by_id(name).num_shards)
+
+    def test_in_transaction(self):
+        name = 'testcounter'
+        counters.ShardConfig.get_num_shards(name)
+        def txn():
+            counters.increment(name)
+            raise ndb.Rollback()
+        ndb.transaction(txn, xg=True)
+        self.assertEqual(0, counters.get_count(name, use_cache=False))
+
+class TestWindowCounters(tests.TestBase):
+    def test_joins_transaction(self):
+        now = 1000 * 60 * 60 * 24
+        def work():
+            tests.TestModel(number=1).put()
+            counters.increment_window('views', resolutions=['minute', 'hour'], now=now)
+        ndb.transaction(work, xg=True)
+        self.assertEqual(1, counters.get_window_count('views', 'hour', now=now))
+
+    def test_buckets(self):
+        name = 'views'
+        now = 1000 * 60 * 60 * 24 # a day boundary
+        counters.increment_window(name, now=now - 61)  # two minutes ago
+        counters.increment_window(name, now=now - 1)   # last minute
+        counters.increment_window(name, delta=2, now=now)
+        counters.increment_window(name, now=now + 59)
+        self.assertEqual(3, counters.get_window_count(name, now=now + 59))
+        self.assertEqual([(now, 3), (now - 60, 1), (now - 120, 1)], 
+                counters.get_window_counts(name, buckets=3, now=now + 30))
+        self.assertEqual(5, counters.get_window_count(name, 'minute', 15, now=now + 30))
+        self.assertEqual(3, counters.get_window_count(name, 'hour', now=now))
+        self.assertEqual(5, counters.get_window_count(name, 'day', buckets=2, now=now))
+
+    def test_cached(self):
+        name = 'views'
+        now = time.time()
+        counters.increment_window(name, now=now)
+        self.assertEqual(1, counters.get_window_count(name, now=now))
+        # cached total is kept up to date by increments
+        counters.increment_window(name, delta=4, now=now)
+        self.assertEqual(5, counters.get_window_count(name, now=now))
+        # one bucket per resolution
+        self.assertEqual(5 * 3, sum(shard.count for shard in counters.WindowShard.query()))
+
+    def test_purge(self):
+        name = 'views'
+        long_ago = time.time() - 60 * 60 * 24 * 365
+        counters.increment_window(name, now=long_ago)
+        counters.increment_window(name)
+        self.assertEqual(3, counters.purge_windows())
+        self.assertEqual(3, counters.WindowShard.query().count())
+
+class TestShardConfigCache(tests.TestBase):
+    def setUp(self):
+        super(TestShardConfigCache, self).setUp()
+        counters._config_cache.clear()
+
+    def test_cached(self):
+        name = 'testcounter'
+        self.assertEqual(counters.DEFAULT_NUM_SHARDS, counters.ShardConfig.get_num_shards(name))
+        # change behind the cache's back; both tiers still answer
+        config = counters.ShardConfig.get_by_id(name)
+        config.num_shards = 20
+        config.put()
+        self.assertEqual(counters.DEFAULT_NUM_SHARDS, counters.ShardConfig.get_num_shards(name))
+        counters._config_cache.clear()
+        self.assertEqual(counters.DEFAULT_NUM_SHARDS, counters.ShardConfig.get_num_shards(name))
+
+    def test_increase_shards_invalidates(self):
+        name = 'testcounter'
+        counters.increment(name)
+        counters.increase_shards(name, 20)
+        self.assertEqual(20, counters.ShardConfig.get_num_shards(name))
+        self.assertEqual(20, len(counters.ShardConfig.all_keys(name)))
+        # never decreases
+        counters.increase_shards(name, 5)
+        self.assertEqual(20, counters.ShardConfig.get_num_shards(name))
+
+    def test_increase_shards_joins_transaction(self):
+        name = 'testcounter'
+        def work():
+            tests.TestModel(number=1).put()
+            counters.increase_shards(name, 20)
+        ndb.transaction(work, xg=True)
+        self.assertEqual(20, counters.ShardConfig.get_by_id(name).num_shards)
+
+    def test_local_size(self):
+        for i in range(0, counters.CONFIG_LOCAL_SIZE + 5):
+            counters._config_cache['counter%i' % i] = (1, 0)
+        counters.ShardConfig.get_num_shards('testcounter')
+        self.assertEqual(counters.CONFIG_LOCAL_SIZE, len(counters._config_cache))
+        self.assertTrue('testcounter' in counters._config_cache)
+
+class TestBufferedCounters(tests.TestBase):
+    def setUp(self):
+        super(TestBufferedCounters, self).setUp()
+        counters._last_flush.clear()
+
+    def shard_total(self, name):
+        shards = filter(None, ndb.get_multi(counters.ShardConfig.all_keys(name)))
+        return sum(shard.count for shard in shards)
+
+    def test_buffered(self):
+        name = 'testcounter'
+        for i in range(0, 5):
+            counters.increment(name, buffered=True)
+        # waiting in memcache, not written yet
+        self.assertEqual(0, self.shard_total(name))
+        self.assertEqual(5, counters.get_count(name))
+        self.assertEqual(5, counters.flush(name))
+        self.assertEqual(5, self.shard_total(name))
+        self.assertEqual(5, counters.get_count(name))
+        # nothing left to flush
+        self.assertEqual(0, counters.flush(name))
+
+    def test_buffered_deferred(self):
+        name = 'testcounter'
+        counters.increment(name, buffered=True)
+        counters.increment(name, buffered=True)
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(1, len(tasks))
+        deferred.run(tasks[0].payload)
+        self.assertEqual(2, self.shard_total(name))
+
+    def test_last_flush_size(self):
+        for i in range(0, counters.BUFFER_LOCAL_SIZE + 5):
+            counters._flushed('buffer%i' % i)
+        self.assertEqual(counters.BUFFER_LOCAL_SIZE, len(counters._last_flush))
+
+    def test_threshold(self):
+        name = 'testcounter'
+        counters.increment(name, delta=counters.BUFFER_THRESHOLD - 1, buffered=True)
+        self.assertEqual(0, self.shard_total(name))
+        counters.increment(name, buffered=True)
+        self.assertEqual(counters.BUFFER_THRESHOLD, self.shard_total(name))
+        self.assertEqual(counters.BUFFER_THRESHOLD, counters.get_count(name))
+
+    def test_mixed(self):
+        name = 'testcounter'
+        counters.increment(name, delta=3, buffered=True)
+        counters.increment(name, delta=2)
+        counters.increment(name, delta=-1, buffered=True) # goes straight through
+        self.assertEqual(4, counters.get_count(name))
+        self.assertEqual(1, self.shard_total(name))
+        counters.flush(name)
+        self.assertEqual(4, counters.get_count(name, use_cache=False))
+
 class TestSimpleCounter(tests.TestBase):
     def test_incr_none_existing(self):
         Counter.increment(name='foo')
@@ -52,6 +265,46 @@ class TestSimpleCounter(tests.TestBase):
         counter = Counter.get_or_create(name='foo')
         self.assertEqual(2, counter.count)
 
+    def test_set(self):
+        Counter.set(name='foo', value=7)
+        self.assertEqual(7, Counter.get('foo').count)
+        Counter.increment(name='foo')
+        Counter.set(name='foo', value=2)
+        self.assertEqual(2, Counter.get('foo').count)
+        self.assertEqual(1, len(Counter.query().fetch()))
+
+    def test_approximate(self):
+        counters._last_flush.clear()
+        for i in range(0, 3):
+            Counter.increment(name='foo', approximate=True)
+        # nothing persisted yet
+        self.assertTrue(Counter.get('foo') is None)
+        self.assertEqual(3, Counter.flush('foo'))
+        self.assertEqual(3, Counter.get('foo').count)
+        self.assertEqual(0, Counter.flush('foo'))
+        # a big enough amount is persisted right away
+        Counter.increment(name='foo', delta=counters.BUFFER_THRESHOLD, approximate=True)
+        self.assertEqual(3 + counters.BUFFER_THRESHOLD, Counter.get('foo').count)
+
+    def test_approximate_deferred(self):
+        counters._last_flush.clear()
+        Counter.increment(name='foo', approximate=True)
+        Counter.increment(name='foo', approximate=True)
+        # a quiet counter still gets flushed, by one delayed task
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(1, len(tasks))
+        deferred.run(tasks[0].payload)
+        self.assertEqual(2, Counter.get('foo').count)
+
+    def test_multi(self):
+        Counter.increment_multi(dict(foo=1, bar=2))
+        Counter.increment_multi(dict(foo=1))
+        Counter.increment_multi(dict(foo=5), domain='zzz')
+        self.assertEqual(dict(foo=2, bar=2, baz=0), Counter.get_counts(['foo', 'bar', 'baz']))
+        self.assertEqual(dict(foo=5), Counter.get_counts(['foo'], domain='zzz'))
+        self.assertEqual('zzz', Counter.get('foo', domain='zzz').domain)
+
     def test_domain(self):
         # this one does NOT belong to a domain
         Counter.increment(name='foo')
@@ -0,0 +1,56 @@
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import tests
+
+import gaeutils
+
+class TestEnqueue(tests.TestBase):
+    def tasks(self, url=None):
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return stub.get_filtered_tasks(url=url, queue_names=['default'])
+
+    def test_safe_enqueue(self):
+        task = gaeutils.safe_enqueue('/worker/test', params=dict(a=1))
+        self.assertTrue(task.was_enqueued)
+        self.assertEqual(1, len(self.tasks(url='/worker/test')))
+
+    def test_already_exists(self):
+        gaeutils.safe_enqueue('/worker/test', name='once')
+        task = gaeutils.safe_enqueue('/worker/test', name='once') # no error
+        self.assertFalse(task.was_enqueued)
+        self.assertEqual(1, len(self.tasks(url='/worker/test')))
+
+    @ndb.toplevel
+    def test_safe_enqueue_async(self):
+        futures = [gaeutils.safe_enqueue_async('/worker/test', name='task-%i' % i)
+                for i in xrange(0, 10)]
+        for future in futures:
+            self.assertTrue(future.get_result().was_enqueued)
+        self.assertEqual(10, len(self.tasks(url='/worker/test')))
+
+    def test_batch(self):
+        # more than fits in one rpc
+        tasks = [taskqueue.Task(url='/worker/test', name='task-%i' % i)
+                for i in xrange(0, taskqueue.MAX_TASKS_PER_ADD + 5)]
+        gaeutils.safe_enqueue_batch(tasks)
+        self.assertEqual(len(tasks), len(self.tasks(url='/worker/test')))
+
+    def test_batch_some_exist(self):
+        gaeutils.safe_enqueue('/worker/test', name='task-0')
+        tasks = [taskqueue.Task(url='/worker/test', name='task-%i' % i)
+                for i in xrange(0, 3)]
+        gaeutils.safe_enqueue_batch(tasks) # no error
+        self.assertFalse(tasks[0].was_enqueued)
+        self.assertTrue(tasks[1].was_enqueued)
+        self.assertEqual(3, len(self.tasks(url='/worker/test')))
+
+    def test_batch_several_exist(self):
+        gaeutils.safe_enqueue('/worker/test', name='task-0')
+        gaeutils.safe_enqueue('/worker/test', name='task-2')
+        tasks = [taskqueue.Task(url='/worker/test', name='task-%i' % i)
+                for i in xrange(0, 4)]
+        gaeutils.safe_enqueue_batch(tasks) # no error
+        self.assertEqual([False, True, False, True], [task.was_enqueued for task in tasks])
+        self.assertEqual(4, len(self.tasks(url='/worker/test')))
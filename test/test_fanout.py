@@ -1,4 +1,9 @@
+import os
+import tempfile
+import time
+
 from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 
 import tests
 
@@ -11,11 +16,18 @@ class SubscriptionTest(fanout.Subscription):
 class Subscriber(ndb.Model):
     name = ndb.StringProperty()
 
+class PublishSub(fanout.Subscription):
+    match_fields = ('author', 'pub_type')
+    author   = ndb.KeyProperty()
+    pub_type = ndb.StringProperty(repeated=True)
+
 class TestFanout(tests.TestBase):
     def setUp(self):
         super(TestFanout, self).setUp()
         self.sub = SubscriptionTest(match='abc')
         self.sub.put()
+        # indexes live in the instance, across testbeds
+        fanout.models.match._indexes.clear()
         self.subscriber1 = Subscriber(name='fred')
         self.subscriber2 = Subscriber(name='alice')
         self.subscriber1.put()
@@ -28,12 +40,122 @@ class TestFanout(tests.TestBase):
 
         self.subscribers = Subscriber.query().fetch()
 
+    def tasks(self, url=None):
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return stub.get_filtered_tasks(url=url, queue_names=['default'])
+
     def testSubcribe(self):
         self.sub.subscribe(self.subscriber1)
         shards = self.sub.shards()
         self.assertEqual(1, len(shards))
         self.assertTrue(self.subscriber1.key in shards[0].subscribers)
 
+    def testMembershipIndex(self):
+        self.assertFalse(self.sub.subscribed(self.subscriber1))
+        self.sub.subscribe(self.subscriber1)
+        self.assertTrue(self.sub.subscribed(self.subscriber1))
+        member = fanout.models.Membership.gen_key(self.sub.key, self.subscriber1.key).get()
+        self.assertTrue(self.subscriber1.key in member.shard.get().subscribers)
+        self.sub.unsubscribe(self.subscriber1)
+        self.assertFalse(self.sub.subscribed(self.subscriber1))
+
+    def testOpenShard(self):
+        _subscriber_size = 4
+        self.more_subscribers(n=9) # 11 in all
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber, shard_size=_subscriber_size)
+        pointer = fanout.models.OpenShard.gen_key(self.sub.key).get()
+        # the last shard created is the one with room
+        shard = pointer.shard.get()
+        self.assertTrue(shard.subscriber_count < _subscriber_size)
+        self.assertEqual(3, len(self.sub.shards()))
+
+    def testReindex(self):
+        self.more_subscribers(n=10)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber)
+        ndb.delete_multi(fanout.models.Membership.query(ancestor=self.sub.key).fetch(keys_only=True))
+        self.assertFalse(self.sub.subscribed(self.subscribers[0]))
+        self.sub.reindex()
+        for subscriber in self.subscribers:
+            self.assertTrue(self.sub.subscribed(subscriber))
+
+    def testSubscribeMany(self):
+        _subscriber_size, _shard_num = 4, 3
+        self.more_subscribers(n=40)
+        self.sub.subscribe(self.subscribers[0], shard_size=_subscriber_size)
+        added = self.sub.subscribe_many(self.subscribers + self.subscribers[:5], 
+                shard_size=_subscriber_size, shard_child_limit=_shard_num, batch_size=15)
+        self.assertEqual(len(self.subscribers) - 1, added)
+        shards = self.sub.shards()
+        # packed full except for the last one
+        self.assertEqual(-(-len(self.subscribers) // _subscriber_size), len(shards))
+        members = [ref for shard in shards for ref in shard.subscribers]
+        self.assertEqual(sorted(members), sorted(sub.key for sub in self.subscribers))
+        for shard in shards:
+            self.assertTrue(shard.subscriber_count <= _subscriber_size)
+            self.assertTrue(shard.shard_child_count <= _shard_num)
+            self.assertEqual(shard.shard_child_count, 
+                    len([child for child in shards if child.key.parent() == shard.key]))
+        for subscriber in self.subscribers:
+            self.assertTrue(self.sub.subscribed(subscriber))
+        # single subscribe carries on from there
+        extra = Subscriber(name='extra')
+        extra.put()
+        self.sub.subscribe(extra, shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        self.assertEqual(1, len(self.sub.shards(ref=extra.key, limit=10)))
+
+    def testSubscribeManyLayout(self):
+        # the same tree shape as one at a time
+        _subscriber_size, _shard_num = 2, 3
+        self.more_subscribers(n=30)
+        other = SubscriptionTest(match='xyz')
+        other.put()
+        for subscriber in self.subscribers:
+            other.subscribe(subscriber, shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        self.sub.subscribe_many(self.subscribers, 
+                shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        depths = lambda sub: sorted(shard.depth for shard in sub.shards())
+        self.assertEqual(depths(other), depths(self.sub))
+
+    def testUnsubscribeMany(self):
+        self.more_subscribers(n=10)
+        self.sub.subscribe_many(self.subscribers, shard_size=4)
+        leaving = self.subscribers[:6] + [Subscriber(name='never').put()]
+        self.assertEqual(6, self.sub.unsubscribe_many(leaving))
+        for subscriber in self.subscribers:
+            self.assertEqual(subscriber in self.subscribers[6:], self.sub.subscribed(subscriber))
+        members = [ref for shard in self.sub.shards() for ref in shard.subscribers]
+        self.assertEqual(sorted(members), sorted(sub.key for sub in self.subscribers[6:]))
+
+    def testSubscribeLater(self):
+        self.more_subscribers(n=10)
+        for subscriber in self.subscribers:
+            self.sub.subscribe_later(subscriber, '/worker/merge', queue_name='default')
+        # logged, not merged
+        self.assertEqual(0, len(self.sub.shards()))
+        self.assertFalse(self.sub.subscribed(self.subscribers[0]))
+        # one merge task for the lot, two if the interval rolled over
+        self.assertTrue(1 <= len(self.tasks(url='/worker/merge')) <= 2)
+
+        self.sub.unsubscribe_later(self.subscribers[0], '/worker/merge', queue_name='default')
+        self.assertEqual(len(self.subscribers), self.sub.merge_pending())
+        for subscriber in self.subscribers[1:]:
+            self.assertTrue(self.sub.subscribed(subscriber))
+        self.assertFalse(self.sub.subscribed(self.subscribers[0]))
+        self.assertEqual(0, fanout.models.PendingSubscriber.query().count())
+        # nothing left
+        self.assertEqual(0, self.sub.merge_pending())
+
+    def testSubscribeLaterMergeWaits(self):
+        from gaeutils.fanout.models import _MERGE_INTERVAL
+        started = time.time()
+        self.sub.subscribe_later(self.subscriber1, '/worker/merge', queue_name='default')
+        slot_end = (int(started / _MERGE_INTERVAL) + 1) * _MERGE_INTERVAL
+        # a full interval after anything logged in the slot
+        for task in self.tasks(url='/worker/merge'):
+            self.assertTrue(task.eta_posix >= slot_end + _MERGE_INTERVAL - 1)
+
     def testUnsubscribe(self):
         # unsubscribe w/ no subscription
         self.subscriber3 = Subscriber(name='alice')
@@ -70,6 +192,13 @@ class TestFanout(tests.TestBase):
             self.sub.subscribe(subscriber)
         self.sub.do_work('/worker/test', queue_name='default')
 
+    def testDoWorkTasks(self):
+        self.more_subscribers(n=20)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber)
+        self.sub.do_work('/worker/test', queue_name='default')
+        self.assertEqual(1, len(self.tasks(url='/worker/test')))
+
     def testDoWorkShard(self):
         # this emulates the webhook at shard_url
         self.more_subscribers(n=20)
@@ -78,3 +207,306 @@ class TestFanout(tests.TestBase):
         shards = self.sub.shards()
         shards[0].do_work('/worker/test', '/worker/accept_subscribers', queue_name='default')
 
+    def testDoWorkShardWorkTask(self):
+        self.more_subscribers(n=20)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber)
+        shards = self.sub.shards()
+        shards[0].do_work('/worker/test', '/worker/accept_subscribers', 
+                params=dict(job_id='job1'), queue_name='default')
+        self.assertEqual(1, len(self.tasks(url='/worker/accept_subscribers')))
+
+    def testDoWorkBatchedChildren(self):
+        _subscriber_size, _shard_num = 2, 3
+        self.more_subscribers(n=20)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber, shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        root = [shard for shard in self.sub.shards() if shard.depth == 0][0]
+        root.do_work('/worker/test', '/worker/accept_subscribers', 
+                params=dict(job_id='job1'), queue_name='default')
+        self.assertEqual(len(root.children), len(self.tasks(url='/worker/test')))
+        # same job again does not duplicate child tasks
+        root.do_work('/worker/test', '/worker/accept_subscribers', 
+                params=dict(job_id='job1'), queue_name='default')
+        self.assertEqual(len(root.children), len(self.tasks(url='/worker/test')))
+
+
+    def testJobCompletion(self):
+        _subscriber_size = 5
+        self.more_subscribers(n=8)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber, shard_size=_subscriber_size)
+        shards = self.sub.shards()
+        job_id = self.sub.do_work('/worker/test', completion_url='/worker/done', queue_name='default')
+        job = fanout.FanoutJob.get_by_id(job_id)
+        self.assertEqual(len(shards), job.expected_shards)
+        self.assertEqual(len(self.subscribers), job.expected_subscribers)
+        # emulate the work handler for each shard
+        for shard in shards:
+            self.assertEqual(0, len(self.tasks(url='/worker/done')))
+            fanout.FanoutJob.record(job_id, shard.key.urlsafe(), shard.subscriber_count)
+        self.assertEqual(1, len(self.tasks(url='/worker/done')))
+        # a repeated record does not fire again
+        fanout.FanoutJob.record(job_id, shards[0].key.urlsafe(), 0)
+        self.assertEqual(1, len(self.tasks(url='/worker/done')))
+        stats = fanout.FanoutJob.get_by_id(job_id).stats()
+        self.assertTrue(stats['completed'])
+        self.assertEqual(len(self.subscribers), stats['subscribers'])
+
+    def testCompactPayload(self):
+        from gaeutils.fanout.models import encode_subscribers, decode_subscribers
+        self.more_subscribers(n=5)
+        keys = [subscriber.key for subscriber in self.subscribers]
+        keys.append(ndb.Key('Subscriber', 'named', parent=self.sub.key))
+        for compress in (False, True):
+            self.assertEqual(keys, decode_subscribers(encode_subscribers(keys, compress=compress)))
+
+    def testDoWorkPayload(self):
+        self.more_subscribers(n=5)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber)
+        shard = self.sub.shards()[0]
+        for i, payload in enumerate((fanout.PAYLOAD_COMPACT, fanout.PAYLOAD_SHARD)):
+            shard.do_work('/worker/test', '/worker/accept_subscribers', 
+                    params=dict(job_id='job%i' % i, payload=payload), queue_name='default')
+        tasks = self.tasks(url='/worker/accept_subscribers')
+        self.assertEqual(2, len(tasks))
+        for task in tasks:
+            params = task.extract_params()
+            self.assertFalse('subscriber_keys' in params)
+            self.assertEqual(shard.subscribers, fanout.work_subscribers(params))
+
+    def testDispatchFlat(self):
+        _subscriber_size, _shard_num = 2, 2
+        self.more_subscribers(n=20)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber, shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        shards = self.sub.shards()
+        self.assertTrue(max(shard.depth for shard in shards) > 1)
+        # every shard gets its work task straight away, whatever its depth
+        job_id = self.sub.dispatch('/worker/accept_subscribers', batch_size=5, queue_name='default')
+        tasks = self.tasks(url='/worker/accept_subscribers')
+        self.assertEqual(len(shards), len(tasks))
+        self.assertEqual(sorted(shard.key for shard in shards), 
+                sorted(ndb.Key(urlsafe=task.extract_params()['shard']) for task in tasks))
+        # a retried dispatch does not deliver twice
+        self.sub.dispatch('/worker/accept_subscribers', job_id=job_id, queue_name='default')
+        self.assertEqual(len(shards), len(self.tasks(url='/worker/accept_subscribers')))
+
+    def testDispatchRanges(self):
+        self.more_subscribers(n=20)
+        # other subscriptions with plenty of shards of their own
+        for i in xrange(0, 5):
+            other = SubscriptionTest(match=str(i))
+            other.put()
+            other.subscribe_many(self.subscribers, shard_size=1)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber, shard_size=2)
+        shards = self.sub.shards()
+        self.sub.dispatch('/worker/accept_subscribers', dispatch_url='/worker/dispatch', 
+                dispatchers=3, payload=fanout.PAYLOAD_KEYS, queue_name='default')
+        dispatchers = self.tasks(url='/worker/dispatch')
+        self.assertEqual(3, len(dispatchers))
+        # emulate the dispatch_url handler
+        for task in dispatchers:
+            self.sub.dispatch_range(task.extract_params(), queue_name='default')
+        tasks = self.tasks(url='/worker/accept_subscribers')
+        self.assertEqual(len(shards), len(tasks))
+        delivered = sum([fanout.work_subscribers(task.extract_params()) for task in tasks], [])
+        self.assertEqual(len(self.subscribers), len(delivered))
+
+    def testCompact(self):
+        _subscriber_size, _shard_num = 2, 2
+        self.more_subscribers(n=20)
+        self.sub.subscribe_many(self.subscribers, shard_size=_subscriber_size, shard_child_limit=_shard_num)
+        before = self.sub.shards()
+        # leave holes in most shards
+        leaving = [shard.subscribers[0] for shard in before[:-1]]
+        self.sub.unsubscribe_many(leaving)
+        staying = [subscriber.key for subscriber in self.subscribers if subscriber.key not in leaving]
+
+        more = self.sub.compact(url='/worker/compact', shard_size=_subscriber_size, batch_size=3, steps=2, 
+                queue_name='default')
+        while more:
+            more = self.sub.compact(shard_size=_subscriber_size, batch_size=3)
+        after = self.sub.shards()
+        self.assertTrue(len(after) < len(before))
+        self.assertTrue(max(shard.depth for shard in after) <= max(shard.depth for shard in before))
+        self.assertTrue(len(self.tasks(url='/worker/compact')) <= 1)
+        # everyone stays subscribed, indexed to the shard holding them
+        held = dict((ref, shard.key) for shard in after for ref in shard.subscribers)
+        self.assertEqual(sorted(staying), sorted(held.keys()))
+        for ref in staying:
+            member = fanout.models.Membership.gen_key(self.sub.key, ref).get()
+            self.assertEqual(held[ref], member.shard)
+
+    def testDispatchThrottled(self):
+        self.more_subscribers(n=6)
+        self.sub.subscribe_many(self.subscribers, shard_size=2)
+        shards = self.sub.shards()
+        # 2 subscribers a shard at 10 a second is a task every 0.2 seconds
+        self.sub.dispatch('/worker/accept_subscribers', rate=10, queue_name='default')
+        tasks = self.tasks(url='/worker/accept_subscribers')
+        self.assertEqual(len(shards), len(tasks))
+        etas = sorted(task.eta for task in tasks)
+        spread = (etas[-1] - etas[0]).total_seconds()
+        self.assertTrue(0.2 * (len(shards) - 1) - 0.1 <= spread <= 0.2 * (len(shards) - 1) + 0.1)
+        # the next job is paced on its own
+        params = dict(job_id='other', rate=10)
+        shards[0].do_work('/worker/test', '/worker/other', params=params, queue_name='default')
+        self.assertEqual(1, len(self.tasks(url='/worker/other')))
+
+    def testThrottleBackoff(self):
+        throttle = fanout.Throttle('job1', rate=100)
+        self.assertEqual(100, throttle.current_rate())
+        fanout.Throttle.failed('job1', n=10)
+        self.assertTrue(throttle.current_rate() < 100)
+        self.assertEqual(throttle.queue_for(self.sub.key), None)
+        throttle = fanout.Throttle.from_params(dict(job_id='job1', queues='a,b'))
+        self.assertTrue(throttle.queue_for(self.sub.key) in ('a', 'b'))
+
+    def testMatching(self):
+        fred, alice = self.subscriber1.key, self.subscriber2.key
+        fred_news = PublishSub(author=fred, pub_type=['news'])
+        fred_any = PublishSub(author=fred)
+        alice_news = PublishSub(author=alice, pub_type=['news', 'blog'])
+        anyone_blog = PublishSub(pub_type=['blog'])
+        ndb.put_multi([fred_news, fred_any, alice_news, anyone_blog])
+
+        def matching(**event):
+            return sorted(PublishSub.matching_keys(event))
+        self.assertEqual(sorted([fred_news.key, fred_any.key]), matching(author=fred, pub_type='news'))
+        self.assertEqual(sorted([alice_news.key, anyone_blog.key]), matching(author=alice, pub_type='blog'))
+        self.assertEqual(sorted([fred_any.key, anyone_blog.key]), matching(author=fred, pub_type=['blog']))
+        # changes are seen through the version in memcache
+        fred_any.key.delete()
+        self.assertEqual([anyone_blog.key], matching(author=fred, pub_type='blog'))
+        fred_blog = PublishSub(author=fred, pub_type=['blog'])
+        fred_blog.put()
+        self.assertEqual(sorted([fred_blog.key, anyone_blog.key]), matching(author=fred, pub_type='blog'))
+        self.assertEqual(sorted([fred_blog.key, anyone_blog.key]), 
+                sorted(sub.key for sub in PublishSub.matching(dict(author=fred, pub_type='blog'))))
+
+    def testPullQueue(self):
+        # a pull queue needs a queue.yaml
+        root = tempfile.mkdtemp()
+        with open(os.path.join(root, 'queue.yaml'), 'w') as f:
+            f.write('queue:\n- name: fanout-pull\n  mode: pull\n')
+        self.testbed.init_taskqueue_stub(root_path=root)
+
+        self.more_subscribers(n=8)
+        self.sub.subscribe_many(self.subscribers, shard_size=3)
+        shards = self.sub.shards()
+        job_id = self.sub.dispatch(None, pull_queue='fanout-pull', track=True)
+        roots = [shard for shard in shards if shard.depth == 0]
+        for shard in roots:
+            shard.do_work('/worker/shard', None, 
+                    params=dict(job_id='tree', pull_queue='fanout-pull'), queue_name='default')
+
+        seen = []
+        done = fanout.work_pull_queue('fanout-pull', seen.extend, tag=job_id)
+        self.assertEqual(len(shards), done)
+        self.assertEqual(sorted(subscriber.key for subscriber in self.subscribers), 
+                sorted(subscriber.key for subscriber in seen))
+        self.assertTrue(fanout.FanoutJob.get_by_id(job_id).completed is not None)
+        # the tree fanout's items are left for another lease
+        self.assertEqual(len(roots), fanout.work_pull_queue('fanout-pull', seen.extend, fetch=False))
+        self.assertEqual(0, fanout.work_pull_queue('fanout-pull', seen.extend))
+
+    def testJobCompletionEvicted(self):
+        from google.appengine.api import memcache
+        self.more_subscribers(n=8)
+        self.sub.subscribe_many(self.subscribers, shard_size=5)
+        shards = self.sub.shards()
+        job_id = self.sub.do_work('/worker/test', completion_url='/worker/done', queue_name='default')
+        for shard in shards[:-1]:
+            fanout.FanoutJob.record(job_id, shard.key, shard.subscriber_count)
+        # the atomic count and the cached totals are gone; the shards still know
+        memcache.flush_all()
+        fanout.FanoutJob.record(job_id, shards[-1].key, shards[-1].subscriber_count)
+        self.assertEqual(1, len(self.tasks(url='/worker/done')))
+
+    def testMatchingRebuildLimit(self):
+        from google.appengine.api import memcache
+        from gaeutils.fanout import match
+        fred = self.subscriber1.key
+        first = PublishSub(author=fred)
+        first.put()
+        self.assertEqual([first.key], PublishSub.matching_keys(dict(author=fred)))
+        # a put on another instance: the version moves, this index never saw it
+        second = PublishSub(author=fred)
+        second.put()
+        cached = match._indexes[PublishSub._get_kind()]
+        cached[0].remove(second.key)
+        memcache.incr(match._VERSION_KEY.format(PublishSub._get_kind()))
+        # served as is until the index is old enough to rebuild
+        self.assertEqual([first.key], PublishSub.matching_keys(dict(author=fred)))
+        cached[2] -= match._REBUILD_INTERVAL + 1
+        self.assertEqual(sorted([first.key, second.key]), sorted(PublishSub.matching_keys(dict(author=fred))))
+
+    def testMatchingCopyOnChange(self):
+        from gaeutils.fanout import match
+        fred = self.subscriber1.key
+        first = PublishSub(author=fred)
+        first.put()
+        self.assertEqual([first.key], PublishSub.matching_keys(dict(author=fred)))
+        index = match._indexes[PublishSub._get_kind()][0]
+        second = PublishSub(author=fred)
+        second.put()
+        # an index being matched elsewhere is left alone
+        self.assertEqual(set([first.key]), index.match(dict(author=fred)))
+        self.assertEqual(sorted([first.key, second.key]), sorted(PublishSub.matching_keys(dict(author=fred))))
+
+    def testMatchingTransaction(self):
+        fred = self.subscriber1.key
+        first = PublishSub(author=fred)
+        first.put()
+        self.assertEqual([first.key], PublishSub.matching_keys(dict(author=fred)))
+        class Rollback(Exception):
+            pass
+        def txn():
+            PublishSub(author=fred).put()
+            raise Rollback()
+        self.assertRaises(Rollback, ndb.transaction, txn)
+        self.assertEqual([first.key], PublishSub.matching_keys(dict(author=fred)))
+        second = ndb.transaction(lambda: PublishSub(author=fred).put())
+        self.assertEqual(sorted([first.key, second]), sorted(PublishSub.matching_keys(dict(author=fred))))
+
+    def testCompactLeafDonors(self):
+        self.more_subscribers(n=20)
+        self.sub.subscribe_many(self.subscribers, shard_size=2, shard_child_limit=2)
+        shards = self.sub.shards()
+        interior = [shard for shard in shards if shard.shard_child_count]
+        leaves = [shard for shard in shards if not shard.shard_child_count]
+        self.assertTrue(len(interior) >= 2)
+        # the emptiest shards are interior, the leaf with a hole comes after them
+        leaving = sum([shard.subscribers for shard in interior], []) + leaves[-1].subscribers[:1]
+        self.sub.unsubscribe_many(leaving)
+        self.assertTrue(self.sub._compact_step(2, 10, candidates=len(interior)))
+        self.assertEqual(len(shards) - 1, len(self.sub.shards()))
+
+    def testJobRetriedRecords(self):
+        self.more_subscribers(n=8)
+        self.sub.subscribe_many(self.subscribers, shard_size=3)
+        shards = self.sub.shards()
+        job_id = self.sub.do_work('/worker/test', completion_url='/worker/done', queue_name='default')
+        # the first shard's task keeps failing after recording
+        for i in xrange(0, len(shards)):
+            fanout.FanoutJob.record(job_id, shards[0].key.urlsafe(), shards[0].subscriber_count)
+        self.assertEqual(0, len(self.tasks(url='/worker/done')))
+        for shard in shards[1:]:
+            fanout.FanoutJob.record(job_id, shard.key.urlsafe(), shard.subscriber_count)
+        self.assertEqual(1, len(self.tasks(url='/worker/done')))
+        stats = fanout.FanoutJob.get_by_id(job_id).stats()
+        self.assertEqual(len(shards), stats['shards'])
+        self.assertEqual(len(self.subscribers), stats['subscribers'])
+
+    def testDoWorkShardRetried(self):
+        self.more_subscribers(n=5)
+        for subscriber in self.subscribers:
+            self.sub.subscribe(subscriber)
+        shard = self.sub.shards()[0]
+        for i in xrange(0, 2):
+            shard.do_work('/worker/test', '/worker/accept_subscribers', 
+                    params=dict(job_id='job1'), queue_name='default')
+        self.assertEqual(1, len(self.tasks(url='/worker/accept_subscribers')))
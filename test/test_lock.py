@@ -1,3 +1,4 @@
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 import tests
@@ -27,6 +28,13 @@ class TestLock(tests.TestBase):
         lock = locks.Lock.incr('mylock', amount=-1)
         self.assertEqual(lock.ver, 2+5-1)
 
+    def test_async(self):
+        futures = [locks.Lock.incr_async('lock%i' % i) for i in range(0, 3)]
+        self.assertEqual([1, 1, 1], [future.get_result().ver for future in futures])
+        semaphore = locks.Semaphore.get_async('sem').get_result()
+        self.assertEqual('sem', semaphore.name)
+        self.assertEqual(1, locks.Lock.get_async('lock0').get_result().ver)
+
     def test_xaction(self):
         ent = MyModel()
         ent.put()
@@ -86,3 +94,77 @@ class TestLock(tests.TestBase):
             # this is true because that work operation
             # never committed
             self.assertTrue(item.val < 100)
+
+    def test_lease(self):
+        token = locks.Lock.acquire('mylock', ttl=30)
+        self.assertTrue(token)
+        self.assertEqual(None, locks.Lock.acquire('mylock'))
+        # only the owner can release
+        locks.Lock.release('mylock', 'not the owner')
+        self.assertEqual(None, locks.Lock.acquire('mylock'))
+        locks.Lock.release('mylock', token)
+        token = locks.Lock.acquire('mylock')
+        self.assertTrue(token)
+        locks.Lock.release('mylock', token)
+
+    def test_lease_durable(self):
+        token = locks.Lock.acquire('mylock', durable=True)
+        self.assertTrue(token)
+        # memcache forgets, the datastore does not
+        memcache.flush_all()
+        self.assertEqual(None, locks.Lock.acquire('mylock', durable=True))
+        locks.Lock.release('mylock', token, durable=True)
+        self.assertTrue(locks.Lock.acquire('mylock', durable=True))
+
+    def test_lease_with(self):
+        with locks.Lock.lease('mylock') as token:
+            self.assertTrue(token)
+            with self.assertRaises(locks.LockTaken):
+                with locks.Lock.lease('mylock', wait=0.1):
+                    pass
+        # released on the way out
+        with locks.Lock.lease('mylock'):
+            pass
+
+    def test_versions(self):
+        names = ['lock%i' % i for i in range(0, 20)]
+        versions = locks.Lock.get_versions(names)
+        self.assertEqual(dict((name, 0) for name in names), versions)
+        self.assertTrue(locks.Lock.verify(versions))
+
+        changed = locks.Lock.incr_many(names[:3])
+        self.assertEqual([1, 1, 1], [changed[name].ver for name in names[:3]])
+        self.assertFalse(locks.Lock.verify(versions))
+        versions = locks.Lock.get_versions(names)
+        self.assertTrue(locks.Lock.verify(versions))
+
+        locks.Lock.incr_many(dict(lock0=5, lock19=-1))
+        self.assertEqual(6, locks.Lock.get('lock0').ver)
+        self.assertEqual(-1, locks.Lock.get('lock19').ver)
+        with self.assertRaises(ValueError):
+            locks.Lock.incr_many(['lock%i' % i for i in range(0, locks.MAX_XG_GROUPS + 1)])
+
+    def test_verify_xaction(self):
+        ent = MyModel()
+        ent.put()
+        versions = locks.Lock.get_versions(['a', 'b'])
+        locks.Lock.incr('b') # someone else got in
+        def work():
+            entity = ent.key.get()
+            entity.val = 100
+            entity.put()
+            if not locks.Lock.verify(versions):
+                raise ndb.Rollback('versioning or sequence issue')
+        ndb.transaction(work, retries=0, xg=True)
+        self.assertEqual(0, ent.key.get().val)
+
+    def test_lease_stale_release(self):
+        stale = locks.Lock.acquire('mylock', ttl=30)
+        # the lease runs out and someone else takes it
+        memcache.delete(locks.LEASE_KEY.format('mylock'))
+        token = locks.Lock.acquire('mylock', ttl=30)
+        self.assertTrue(token)
+        locks.Lock.release('mylock', stale)
+        self.assertEqual(None, locks.Lock.acquire('mylock'))
+        locks.Lock.release('mylock', token)
+        self.assertTrue(locks.Lock.acquire('mylock'))
@@ -1,8 +1,10 @@
 from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 
 import tests
 
 import gaeutils
+from gaeutils import models
 
 class EmptyModel(ndb.Model):
     pass
@@ -15,6 +17,10 @@ class TestQueryExec(tests.TestBase):
 
         self.query = tests.TestModel.query()
 
+    def tasks(self, url=None):
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return stub.get_filtered_tasks(url=url, queue_names=['default'])
+
     def testGetByPage(self):
         self.assertEqual(len(self.query.fetch()), 30)
 
@@ -49,3 +55,125 @@ class TestQueryExec(tests.TestBase):
         for page in gaeutils.QueryExec(self.query, batch_size=10):
             num_pages += 1
         self.assertEqual(3, num_pages)
+
+    def testPrefetch(self):
+        for prefetch in (1, 2, 5):
+            query_exec = gaeutils.QueryExec(self.query, batch_size=10, prefetch=prefetch)
+            pages = list(query_exec.get_by_page())
+            self.assertEqual([10, 10, 10], [len(page) for page in pages])
+            numbers = sorted(item.number for page in pages for item in page)
+            self.assertEqual(range(0, 30), numbers)
+
+    def testPrefetchEmpty(self):
+        query_exec = gaeutils.QueryExec(EmptyModel.query(), batch_size=10, prefetch=3)
+        self.assertEqual([[]], list(query_exec.get_by_page()))
+
+    def testMapAsync(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=10)
+        self.assertEqual([10, 10, 10], query_exec.map_async(len).get_result())
+
+    def testMapAsyncTasklet(self):
+        @ndb.tasklet
+        def callback(page):
+            entities = yield ndb.get_multi_async([item.key for item in page])
+            raise ndb.Return(len(entities))
+        query_exec = gaeutils.QueryExec(self.query, batch_size=10, prefetch=2)
+        self.assertEqual([10, 10, 10], query_exec.map_async(callback).get_result())
+
+    def testSplitAt(self):
+        keys = sorted(self.query.fetch(keys_only=True))
+        query_exec = gaeutils.QueryExec(tests.TestModel.query(), batch_size=7)
+        parts = query_exec.split_at([keys[10], keys[20]])
+        self.assertEqual(3, len(parts))
+        found = [item.key for part in parts for item in part.get_all()]
+        self.assertEqual(keys, sorted(found))
+        for part in parts:
+            self.assertEqual(10, len(part.get_all()))
+
+    def testSplit(self):
+        # however the sample falls, the ranges cover the query exactly once
+        query_exec = gaeutils.QueryExec(tests.TestModel.query(), batch_size=10)
+        parts = query_exec.split(4)
+        self.assertTrue(1 <= len(parts) <= 4)
+        found = [item.key for part in parts for item in part.get_all()]
+        self.assertEqual(sorted(self.query.fetch(keys_only=True)), sorted(found))
+
+    def testSplitOne(self):
+        query_exec = gaeutils.QueryExec(tests.TestModel.query(), batch_size=10)
+        self.assertEqual(1, len(query_exec.split(1)))
+
+    def testIterEntities(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=7)
+        numbers = sorted(item.number for item in query_exec.iter_entities())
+        self.assertEqual(range(0, 30), numbers)
+
+    def testIterEntitiesKeysOnly(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=7)
+        keys = list(query_exec.iter_entities(keys_only=True))
+        self.assertEqual(30, len(keys))
+        self.assertTrue(all(isinstance(key, ndb.Key) for key in keys))
+
+    def testIterEntitiesMaxItems(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=7)
+        self.assertEqual(12, len(list(query_exec.iter_entities(max_items=12))))
+        self.assertEqual(30, len(list(query_exec.iter_entities(max_items=100))))
+
+    def testIterEntitiesMaxBytes(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=7)
+        size = self.query.get()._to_pb().ByteSize()
+        items = list(query_exec.iter_entities(max_bytes=size * 5))
+        self.assertTrue(0 < len(items) < 30)
+
+    def testRunResumable(self):
+        numbers = []
+        def callback(page):
+            numbers.extend(item.number for item in page)
+        query_exec = gaeutils.QueryExec(self.query, batch_size=10)
+        # no time at all, so one page per run
+        cursor = query_exec.run_resumable(callback, '/worker/scan', time_budget=0)
+        self.assertEqual(10, len(numbers))
+        self.assertEqual(1, len(self.tasks(url='/worker/scan')))
+        while cursor is not None:
+            cursor = query_exec.run_resumable(callback, '/worker/scan', 
+                    cursor=cursor.urlsafe(), time_budget=0)
+        self.assertEqual(range(0, 30), sorted(numbers))
+
+    def testRunResumableCheckpoint(self):
+        numbers = []
+        def callback(page):
+            numbers.extend(item.number for item in page)
+        query_exec = gaeutils.QueryExec(self.query, batch_size=10)
+        runs = 0
+        while query_exec.run_resumable(callback, '/worker/scan', 
+                checkpoint='scan', time_budget=0) is not None:
+            runs += 1
+        self.assertEqual(2, runs)
+        self.assertEqual(range(0, 30), sorted(numbers))
+        checkpoint = models.Checkpoint.get_by_id('scan')
+        self.assertTrue(checkpoint.done)
+        self.assertEqual(30, checkpoint.count)
+        # task params do not carry the cursor; the checkpoint does
+        for task in self.tasks(url='/worker/scan'):
+            self.assertFalse('cursor' in task.extract_params())
+        # done means done
+        self.assertTrue(query_exec.run_resumable(callback, '/worker/scan', checkpoint='scan') is None)
+        self.assertEqual(30, len(numbers))
+
+    def testRunResumableInBudget(self):
+        query_exec = gaeutils.QueryExec(self.query, batch_size=10)
+        self.assertTrue(query_exec.run_resumable(lambda page: None, '/worker/scan') is None)
+        self.assertEqual(0, len(self.tasks(url='/worker/scan')))
+
+    def testSplitAncestor(self):
+        parent = ndb.Key('Parent', 1)
+        ndb.put_multi([tests.TestModel(parent=parent, number=i) for i in xrange(0, 30)])
+        query_exec = gaeutils.QueryExec(tests.TestModel.query(ancestor=parent), batch_size=10)
+        # boundaries all come from under the ancestor
+        for key in query_exec.split_points(4):
+            self.assertEqual(parent, key.parent())
+        found = [item.key for part in query_exec.split(4) for item in part.get_all()]
+        self.assertEqual(30, len(found))
+
+    def testSplitFiltered(self):
+        query_exec = gaeutils.QueryExec(tests.TestModel.query(tests.TestModel.number > 5))
+        self.assertRaises(ValueError, query_exec.split, 4)